@@ -0,0 +1,187 @@
+import os
+import os.path as path
+import json
+import tracemalloc
+import subprocess
+import shutil
+from hashlib import sha256
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Callable, Any, Optional
+from argparse import ArgumentParser
+from yaml import safe_dump
+
+import generate
+
+# runs the generator over made up schemas of increasing size, entirely offline, and reports
+# how long each phase takes, how much memory it peaks at and how much it spits out. results
+# get saved per commit so you can --compare against an older run and see what got slower
+
+RESULTS_DIR = '.bench'
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+TARGETS = ['server', 'frontend', 'thaum']
+
+# a schema with `size` each of enums, classes and endpoints. every fifth class extends the one
+# before it, and the field types cycle through the nested/nullable/typedef'd shapes the
+# serializer emitters have to deal with
+def synthesize_schema(size: int) -> dict[str, Any]:
+    enums = {f'Enum{i}': [f'Value{j}' for j in range(4)] for i in range(size)}
+    classes = {}
+    extensions = {}
+    for i in range(size):
+        other = f'Class{(i + 1) % size}'
+        enum = f'Enum{i}'
+        classes[f'Class{i}'] = {
+            'id': 'Id',
+            'name': 'String',
+            'count': 'int',
+            'kind': enum,
+            'tags': 'List<String>',
+            'byKind': f'Map<{enum}, List<double>>',
+            'children': f'List<{other}?>?',
+            'nested': f'Map<String, List<Map<int, {other}>>>',
+            'stock': 'Stock',
+        }
+        if i % 5 == 4:
+            extensions[f'Class{i - 1}'] = f'Ext{i}'
+
+    endpoints = {}
+    for i in range(size):
+        endpoint = {'out': f'Class{i}'}
+        if i % 2 == 0:
+            endpoint['in'] = f'List<Class{(i + 1) % size}>'
+        if i % 3 == 0:
+            endpoint['authLevel'] = 'Staff'
+        elif i % 7 == 0:
+            endpoint['forwardToken'] = True
+        endpoints[f'endpoint{i}'] = endpoint
+
+    return {
+        'api_url': 'localhost:8080',
+        'use_https': False,
+        'typedefs': {'Id': 'String', 'Stock': 'Map<Enum0, int>'},
+        'enums': enums,
+        'classes': {**classes, 'Credentials': {'username': 'String', 'password': 'String'}},
+        'extensions': extensions,
+        # the token cache shares its key with endpoint response caches, so keep it in here
+        'auth': {'levels': ['Staff', 'Admin'], 'in': 'Credentials', 'out': 'String', 'cache': {'ttl': 30}},
+        'endpoints': endpoints,
+    }
+
+# generate.py keeps a few things around between runs so repeat runs are quick - throw them
+# out so every measurement starts cold
+def reset_generator():
+    generate.type_env = ''
+    generate._manifests.clear()
+    generate._schemas.clear()
+
+def measure(run: Callable[[], Any], memory: bool) -> tuple[Any, dict[str, float]]:
+    if memory:
+        tracemalloc.start()
+    start = perf_counter()
+    result = run()
+    seconds = perf_counter() - start
+    stats = {'seconds': seconds}
+    if memory:
+        stats['peak_mb'] = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+        tracemalloc.stop()
+    return result, stats
+
+# the same steps generate_targets goes through, one at a time so each gets its own numbers
+def run_phases(schema: bytes, target: str, config_dir: str, output_dir: str, memory: bool) -> dict[str, dict[str, float]]:
+    os.makedirs(output_dir)
+    reset_generator()
+    shutil.rmtree(generate.schema_cache_dir, ignore_errors = True)
+    phases = {}
+    schemaHash = sha256(schema).hexdigest()
+    config, phases['parse'] = measure(lambda: generate.parse_schema(schema, schemaHash), memory)
+    # and again straight out of the on-disk cache the first parse left behind
+    generate._schemas.clear()
+    _, phases['parse cached'] = measure(lambda: generate.parse_schema(schema, schemaHash), memory)
+    _, phases['compile'] = measure(lambda: generate.load_config(config), memory)
+
+    with TemporaryDirectory() as chunkDir:
+        for job in ['base'] + generate.TARGET_JOBS[target]:
+            def render():
+                generate.start_sections({})
+                generate.render_job(job, f'{chunkDir}/{job}')
+            _, phases[job] = measure(render, memory)
+            phases[job]['output_bytes'] = path.getsize(f'{chunkDir}/{job}')
+
+    # and the whole thing end to end, including writing the file and the manifest
+    reset_generator()
+    shutil.rmtree(generate.schema_cache_dir, ignore_errors = True)
+    _, phases['total'] = measure(lambda: generate.generate(target, output_dir, config_dir), memory)
+    phases['total']['output_bytes'] = path.getsize(f'{output_dir}/generated.dart')
+    # nothing changed, so this should be the manifest fast path
+    _, phases['unchanged'] = measure(lambda: generate.generate(target, output_dir, config_dir), memory)
+    return phases
+
+def run_size(size: int, targets: list[str], memory: bool) -> dict[str, Any]:
+    results = {}
+    with TemporaryDirectory() as tmp:
+        # a cache of our own, so every run starts from an actual parse
+        generate.schema_cache_dir = f'{tmp}/schemas'
+        schema = safe_dump(synthesize_schema(size)).encode()
+        with open(f'{tmp}/generate.yaml', 'wb') as fh:
+            fh.write(schema)
+        for target in targets:
+            # tracemalloc slows everything down a lot, so times come from a run without it
+            phases = run_phases(schema, target, tmp, f'{tmp}/{target}', False)
+            if memory:
+                for phase, stats in run_phases(schema, target, tmp, f'{tmp}/{target}-memory', True).items():
+                    phases[phase]['peak_mb'] = stats['peak_mb']
+            results[target] = phases
+    return {'schema_bytes': len(schema), 'targets': results}
+
+def git_label() -> str:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output = True, text = True, check = True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output = True, text = True, check = True).stdout.strip()
+        return f'{commit}-dirty' if dirty else commit
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def load_results(label_or_file: str) -> dict[str, Any]:
+    fname = label_or_file if path.exists(label_or_file) else f'{RESULTS_DIR}/{label_or_file}.json'
+    with open(fname, 'rt') as fh:
+        return json.load(fh)
+
+def report(results: dict[str, Any], baseline: Optional[dict[str, Any]]):
+    for size, sizeResults in results['sizes'].items():
+        print(f'--- {size} of each ({sizeResults["schema_bytes"] / 1024:.0f}KB schema)')
+        for target, phases in sizeResults['targets'].items():
+            print(f'{target}:')
+            for phase, stats in phases.items():
+                line = f'  {phase:<12} {stats["seconds"] * 1000:>10.1f}ms'
+                if 'peak_mb' in stats:
+                    line += f' {stats["peak_mb"]:>9.1f}MB'
+                if 'output_bytes' in stats:
+                    line += f' {stats["output_bytes"] / 1024:>9.0f}KB out'
+                old = (baseline or {}).get('sizes', {}).get(size, {}).get('targets', {}).get(target, {}).get(phase)
+                if old is not None and old['seconds'] > 0:
+                    line += f'  ({(stats["seconds"] / old["seconds"] - 1) * 100:+.0f}% vs {baseline["label"]})'
+                print(line)
+
+def main():
+    parser = ArgumentParser(description = 'Benchmark the Thaumaturge generator on synthetic schemas')
+    parser.add_argument('--sizes', type = int, nargs = '+', default = DEFAULT_SIZES, help = 'how many enums, classes and endpoints to generate')
+    parser.add_argument('--targets', nargs = '+', default = TARGETS, choices = TARGETS)
+    parser.add_argument('--no-memory', action = 'store_true', help = "skip the tracemalloc runs (they're slow)")
+    parser.add_argument('--label', help = 'name to save the results under, defaults to the current commit')
+    parser.add_argument('--compare', help = 'label or results file to compare against')
+    args = parser.parse_args()
+
+    label = args.label or git_label()
+    baseline = load_results(args.compare) if args.compare else None
+    results = {'label': label, 'generator': generate.generator_version(), 'sizes': {}}
+    for size in args.sizes:
+        results['sizes'][str(size)] = run_size(size, args.targets, not args.no_memory)
+
+    report(results, baseline)
+    os.makedirs(RESULTS_DIR, exist_ok = True)
+    with open(f'{RESULTS_DIR}/{label}.json', 'wt') as fh:
+        json.dump(results, fh, indent = 2)
+    print(f'Saved results to {RESULTS_DIR}/{label}.json')
+
+if __name__ == '__main__': main()
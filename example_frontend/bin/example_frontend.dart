@@ -120,5 +120,10 @@ Future doStaff() async {
 }
 
 Future main() async {
-  if (optionChoice('Would you like to login as a staff member')) await doStaff(); else await doClient();
+  try {
+    if (optionChoice('Would you like to login as a staff member')) await doStaff(); else await doClient();
+  } finally {
+    // the client keeps its connections alive for reuse, which would keep us running until they time out
+    API.dispose();
+  }
 }
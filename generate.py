@@ -1,6 +1,20 @@
 from io import StringIO
-from yaml import safe_load
-from typing import TypeVar, Any
+from yaml import load
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+from typing import TypeVar, Any, NamedTuple, Callable, Optional, BinaryIO
+from hashlib import sha256
+from contextlib import contextmanager
+from time import perf_counter
+import os
+import os.path as path
+import sys
+import json
+import marshal
+from concurrent.futures import ProcessPoolExecutor
+from tempfile import TemporaryDirectory
 
 enums: list[str]
 classes: list[str]
@@ -15,36 +29,429 @@ V = TypeVar('V')
 def reverse(theDict: dict[K, V]) -> dict[V, K]:
     return {v: k for k, v in theDict.items()}
 
-def get_config(config_dir: str):
-    with open(f'{config_dir}/generate.yaml', 'rt') as fh:
-        return safe_load(fh)
+# config repos get mirrored here by thaum.py, and parsed schemas get cached under it
+CACHE_DIR = os.environ.get(
+    'THAUM_CACHE_DIR',
+    path.join(os.environ.get('XDG_CACHE_HOME', path.expanduser('~/.cache')), 'thaumaturge')
+)
+
+# the last parsed schema is kept in memory and every one is marshalled to disk keyed by its
+# hash, so nothing parses the same generate.yaml twice. only the current schema's worth
+# keeping in memory - under --watch every save is a new one. marshal's format changes
+# between python versions so the version's part of the file name. None turns the disk
+# cache off
+schema_cache_dir: Optional[str] = path.join(CACHE_DIR, 'schemas')
+SCHEMA_CACHE_ENTRIES = 16
+_schemas: dict[str, Any] = {}
+
+def read_schema(config_dir: str) -> tuple[bytes, str]:
+    with open(f'{config_dir}/generate.yaml', 'rb') as fh:
+        schema = fh.read()
+    return schema, sha256(schema).hexdigest()
+
+def parse_schema(schema: bytes, schemaHash: str) -> Any:
+    if schemaHash in _schemas:
+        return _schemas[schemaHash]
+
+    cacheFile = None if schema_cache_dir is None else path.join(schema_cache_dir, f'{schemaHash}.{sys.implementation.cache_tag}.marshal')
+    try:
+        with open(cacheFile, 'rb') as fh:
+            parsed = marshal.load(fh)
+    except (TypeError, OSError, EOFError, ValueError):
+        parsed = load(schema, Loader = SafeLoader)
+        validate_schema(parsed)
+        if cacheFile is not None:
+            write_schema_cache(cacheFile, parsed)
+
+    _schemas.clear()
+    _schemas[schemaHash] = parsed
+    return parsed
+
+def load_schema(config_dir: str) -> Any:
+    return parse_schema(*read_schema(config_dir))
+
+def validate_schema(schema: Any):
+    if not isinstance(schema, dict):
+        raise ValueError('generate.yaml should be a mapping!')
+    for key in ['api_url', 'use_https']:
+        if key not in schema:
+            raise ValueError(f"generate.yaml is missing '{key}'!")
+
+def write_schema_cache(cacheFile: str, schema: Any):
+    try:
+        data = marshal.dumps(schema)
+    except ValueError:
+        # something yaml made that marshal can't do (a date, say) - just parse it every time
+        return
+    os.makedirs(path.dirname(cacheFile), exist_ok = True)
+    tmpFile = f'{cacheFile}.{os.getpid()}.tmp'
+    with open(tmpFile, 'wb') as fh:
+        fh.write(data)
+    os.replace(tmpFile, cacheFile)
+
+    # every edit makes a new entry, so only keep the most recent few
+    entries = sorted((path.join(path.dirname(cacheFile), fname) for fname in os.listdir(path.dirname(cacheFile)) if fname.endswith('.marshal')), key = path.getmtime, reverse = True)
+    for stale in entries[SCHEMA_CACHE_ENTRIES:]:
+        try:
+            os.remove(stale)
+        except OSError:
+            pass
 
 def config_dict(name: str) -> dict[Any, Any]: return config.get(name, {})
 def config_list(name: str) -> list[Any]: return config.get(name, [])
 
-# this could be a decorator but long story short i spent an hour researching
-# how to type annotate functions with the first argument as a string
-# and the rest as generic variadics and discovered it's actually a bug
+WIRE_FORMATS = ['json', 'msgpack']
+
+# bodies at least this big get gzipped, if the other end says it can take it
+def gzip_threshold() -> int:
+    return (config.get('compression') or {}).get('threshold', 1024)
+
+LOG_LEVELS = ['debug', 'info', 'warning', 'error', 'off']
+
+def log_level() -> str:
+    level = config.get('log_level', 'info')
+    if level not in LOG_LEVELS:
+        raise ValueError(f"Unknown log level '{level}'!")
+    return level
+
+# the check is done inline so nothing gets interpolated for messages that are filtered out
+def log(level: str, message: str) -> str:
+    return f'if (logLevel.index <= LogLevel.{level}.index) logSink(LogLevel.{level}, {message});\n'
+
+def metrics_enabled() -> bool:
+    return 'metrics' in config
+
+def metrics_config() -> dict[str, Any]:
+    return config.get('metrics') or {}
+
+def binary_wire() -> bool:
+    wireFormat = config.get('wire_format', 'json')
+    if wireFormat not in WIRE_FORMATS:
+        raise ValueError(f"Unsupported wire format '{wireFormat}'!")
+    return wireFormat == 'msgpack'
+
+# authorizing is just another endpoint as far as the wire's concerned, but it doesn't
+# belong in APIHandler so it's only tacked on when we're emitting dispatch code
+def all_endpoints() -> dict[str, Any]:
+    endpoints = dict(config_dict('endpoints'))
+    if 'auth' in config:
+        endpoints['_authorize'] = config['auth']
+    return endpoints
+
+GENERATED_ENUMS = ['APIException', 'AuthLevel']
+
+# bump this whenever the generated code changes shape - it's baked into the manifest so
+# old outputs get regenerated. the hash of this file covers any changes we forget to bump for
+GENERATOR_VERSION = '1.1'
+MANIFEST_FILE = '.generated.manifest.json'
+
+def file_hash(fname: str) -> str:
+    with open(fname, 'rb') as fh:
+        return sha256(fh.read()).hexdigest()
+
+_generatorVersion: Optional[str] = None
+def generator_version() -> str:
+    global _generatorVersion
+    if _generatorVersion is None:
+        _generatorVersion = f'{GENERATOR_VERSION}+{file_hash(__file__)[:16]}'
+    return _generatorVersion
+
+# long-running callers (thaum.py --watch) call generate() over and over, so hang on to
+# the last manifest for each output dir rather than re-reading it off disk every time
+_manifests: dict[str, dict[str, Any]] = {}
+
+def read_manifest(output_dir: str) -> dict[str, Any]:
+    if output_dir in _manifests:
+        return _manifests[output_dir]
+    try:
+        with open(f'{output_dir}/{MANIFEST_FILE}', 'rt') as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+def write_manifest(output_dir: str, manifest: dict[str, Any]):
+    _manifests[output_dir] = manifest
+    with output_file(f'{output_dir}/{MANIFEST_FILE}') as out:
+        out.write(json.dumps(manifest))
+
+# everything we write goes to a temp file next to the real one and gets renamed over it once
+# it's all there, so a crash halfway through never leaves a half-written file behind. it's
+# hashed on the way through, and if it turns out to be the same as what's already there the
+# original's left alone so its mtime doesn't change
+OUTPUT_BUFFER = 1 << 20
+
+class OutputFile:
+    def __init__(self, fname: str):
+        self.fname = fname
+        self.tmpFile = f'{fname}.{os.getpid()}.tmp'
+        self.fh = open(self.tmpFile, 'wb', buffering = OUTPUT_BUFFER)
+        self.hash = sha256()
+        self.size = 0
+        self.changed = False
+
+    def write(self, text: str):
+        self.write_bytes(text.encode())
+
+    def write_bytes(self, data: bytes):
+        self.hash.update(data)
+        self.fh.write(data)
+        self.size += len(data)
+
+    def copy_from(self, fname: str):
+        with open(fname, 'rb') as fh:
+            while True:
+                data = fh.read(OUTPUT_BUFFER)
+                if not data:
+                    break
+                self.write_bytes(data)
+
+    def digest(self) -> str:
+        return self.hash.hexdigest()
+
+    def finish(self):
+        self.fh.close()
+        self.changed = not path.exists(self.fname) or file_hash(self.fname) != self.digest()
+        if self.changed:
+            os.replace(self.tmpFile, self.fname)
+        else:
+            os.remove(self.tmpFile)
+
+    def abort(self):
+        self.fh.close()
+        os.remove(self.tmpFile)
+
+@contextmanager
+def output_file(fname: str):
+    out = OutputFile(fname)
+    try:
+        yield out
+    except BaseException:
+        out.abort()
+        raise
+    out.finish()
+
+# timing spans for --profile. each one's a {name, seconds, children} dict hung off whichever
+# span was open when it started. with nothing open (the usual case) span() does nothing
+_open_spans: list[dict[str, Any]] = []
+
+def start_profile(name: str) -> dict[str, Any]:
+    root = {'name': name, 'seconds': 0.0, 'children': [], '_start': perf_counter()}
+    _open_spans[:] = [root]
+    return root
+
+def stop_profile() -> dict[str, Any]:
+    root = _open_spans[0]
+    root['seconds'] = perf_counter() - root.pop('_start')
+    _open_spans.clear()
+    return root
+
+def profiling() -> bool:
+    return len(_open_spans) > 0
+
+@contextmanager
+def span(name: str, **details: Any):
+    if not _open_spans:
+        yield
+        return
+    node = {'name': name, **details, 'seconds': 0.0, 'children': []}
+    _open_spans[-1]['children'].append(node)
+    _open_spans.append(node)
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        node['seconds'] = perf_counter() - start
+        _open_spans.pop()
+
+# the output is made of sections (an enum, a class, an endpoint...) and each one is
+# fingerprinted on its own schema data plus everything that can change how types get
+# serialized. if the fingerprint's the same as last run we reuse last run's text, read
+# straight back out of the file it went into - the manifest only keeps where each section
+# starts and how long it is, not the text itself
+previous_sections: dict[str, dict[str, Any]] = {}
+current_sections: dict[str, dict[str, Any]] = {}
+schema_env: str = ''
+_sources: dict[str, BinaryIO] = {}
+
+PER_SECTION_CONFIG = ['enums', 'classes', 'endpoints']
+
+# key order is left alone - fields and endpoints come out in the order they're declared, so
+# moving one around has to count as a change
+def fingerprint(*data: Any) -> str:
+    return sha256(json.dumps(data, default = str).encode()).hexdigest()
+
+def start_sections(previous: dict[str, dict[str, Any]]):
+    global previous_sections, current_sections, schema_env
+    previous_sections = previous
+    current_sections = {}
+    # enums, classes and endpoints are fingerprinted section by section, but any other setting
+    # could change any section
+    settings = {key: value for key, value in config.items() if key not in PER_SECTION_CONFIG}
+    schema_env = fingerprint(settings, type_env)
+
+# the base and each job render into a chunk file of their own, section by section, which
+# write_target then copies into place - so a job's rendered once however many targets need
+# it, and nothing ever holds the whole output in memory. it counts the bytes on the way in so
+# every section knows where it starts
+class Chunk:
+    def __init__(self, fname: str):
+        self.fname = fname
+        self.fh = open(fname, 'wb', buffering = OUTPUT_BUFFER)
+        self.size = 0
+
+    def write(self, text: str):
+        self.write_bytes(text.encode())
+
+    def write_bytes(self, data: bytes):
+        self.fh.write(data)
+        self.size += len(data)
+
+    def close(self):
+        self.fh.close()
+
+@contextmanager
+def chunk_file(fname: str):
+    chunk = Chunk(fname)
+    try:
+        yield chunk
+    finally:
+        chunk.close()
+
+def section(buf: Chunk, key: str, data: Any, render: Callable[[StringIO], None]):
+    if profiling():
+        with span(key):
+            return _section(buf, key, data, render)
+    _section(buf, key, data, render)
+
+def _section(buf: Chunk, key: str, data: Any, render: Callable[[StringIO], None]):
+    sectionFingerprint = fingerprint(schema_env, key, data)
+    previous = previous_sections.get(key)
+    start = buf.size
+    if previous is not None and previous['fingerprint'] == sectionFingerprint:
+        buf.write_bytes(read_section(previous))
+        if profiling():
+            _open_spans[-1]['reused'] = True
+    else:
+        sectionBuf = StringIO()
+        render(sectionBuf)
+        buf.write(sectionBuf.getvalue())
+    current_sections[key] = {'fingerprint': sectionFingerprint, 'offset': start, 'length': buf.size - start}
+
+# reused sections mostly come one after another out of the same few files, so those stay
+# open until everything's rendered
+def read_section(previous: dict[str, Any]) -> bytes:
+    source = _sources.get(previous['source'])
+    if source is None:
+        source = _sources[previous['source']] = open(previous['source'], 'rb')
+    source.seek(previous['offset'])
+    return source.read(previous['length'])
+
+def close_sources():
+    for source in _sources.values():
+        source.close()
+    _sources.clear()
+
+
+# every type string in the schema gets parsed once into one of these. typedefs are expanded
+# and we decide up front whether something's an enum, a class, an extension etc, so the
+# serializer emitters never have to do any string munging or list scans themselves.
 #
-# https://github.com/python/mypy/issues/5876
-def baseType(type: str) -> str:
-    return typedefs.get(type, type)
-
-def isExt(type: str):
-    return type in reverse(config_dict('extensions'))
-
-def extBase(type: str) -> str:
-    type = baseType(type)
-    return reverse(config_dict('extensions'))[type]
-
-def mapTypes(type: str) -> tuple[str, str]:
-    type = baseType(type)
-    # luckily enough this just about works - the
-    # only type w/ a comma in is a map, and you can't use one as a key
-    comma = type.find(',')
-    keyType = type[4:comma]
-    valType = type[comma + 1:-1].strip()
-    return keyType, valType
+# name is the canonical (fully expanded) spelling of the type, which means two type strings
+# that resolve to the same thing share a cache entry
+class TypeNode(NamedTuple):
+    kind: str
+    name: str
+    args: tuple[Any, ...] = ()
+
+NULLABLE = 'nullable'
+LIST = 'list'
+MAP = 'map'
+ENUM = 'enum'
+CLASS = 'class'
+EXT = 'ext'
+PRIMITIVE = 'primitive'
+
+# all of these get rebuilt by compile_schema() whenever the set of type names changes -
+# if it's just fields moving around we can keep everything we've already resolved
+type_env: str = ''
+enum_names: set[str] = set()
+class_names: set[str] = set()
+ext_bases: dict[str, str] = {}
+_resolved: dict[str, TypeNode] = {}
+_fromJsonCache: dict[tuple[str, str, bool], str] = {}
+_toJsonCache: dict[tuple[str, str, bool], str] = {}
+
+def compile_schema():
+    global enums, classes, typedefs, enum_names, class_names, ext_bases, type_env
+
+    enums = list(config_dict('enums').keys())
+    classes = list(config_dict('classes').keys())
+    typedefs = config_dict('typedefs')
+
+    env = fingerprint(sorted(enums), sorted(classes), config_dict('extensions'), typedefs)
+    if env == type_env:
+        return
+    type_env = env
+
+    enum_names = set(enums + GENERATED_ENUMS)
+    class_names = set(classes)
+    ext_bases = reverse(config_dict('extensions'))
+
+    _resolved.clear()
+    _fromJsonCache.clear()
+    _toJsonCache.clear()
+
+def split_type_args(args: str) -> list[str]:
+    out: list[str] = []
+    depth = 0
+    start = 0
+    for i, char in enumerate(args):
+        if char == '<':
+            depth += 1
+        elif char == '>':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            out.append(args[start:i].strip())
+            start = i + 1
+    out.append(args[start:].strip())
+    return out
+
+def resolve_type(type: str, expanding: tuple[str, ...] = ()) -> TypeNode:
+    type = type.strip()
+    node = _resolved.get(type)
+    if node is not None:
+        return node
+
+    if type in typedefs:
+        if type in expanding:
+            raise TypeError(f"Typedef '{type}' refers to itself!")
+        node = resolve_type(typedefs[type], expanding + (type,))
+    elif type.endswith('?'):
+        inner = resolve_type(type[:-1], expanding)
+        node = TypeNode(NULLABLE, f'{inner.name}?', (inner,))
+    elif type.startswith('List<') and type.endswith('>'):
+        inner = resolve_type(type[5:-1], expanding)
+        node = TypeNode(LIST, f'List<{inner.name}>', (inner,))
+    elif type.startswith('Map<') and type.endswith('>'):
+        typeArgs = split_type_args(type[4:-1])
+        if len(typeArgs) != 2:
+            raise TypeError(f"Can't parse map type {type}!")
+        keyType = resolve_type(typeArgs[0], expanding)
+        valType = resolve_type(typeArgs[1], expanding)
+        node = TypeNode(MAP, f'Map<{keyType.name}, {valType.name}>', (keyType, valType))
+    elif type in enum_names:
+        node = TypeNode(ENUM, type)
+    elif type in class_names:
+        node = TypeNode(CLASS, type)
+    elif type in ext_bases:
+        node = TypeNode(EXT, type)
+    else:
+        node = TypeNode(PRIMITIVE, type)
+
+    _resolved[type] = node
+    # so that recursing on an already-resolved node's name is always a cache hit
+    _resolved.setdefault(node.name, node)
+    return node
 
 def generate_enum(buf: StringIO, name: str, values: dict[str, str]):
     buf.write(f'enum {name} {{\n')
@@ -78,77 +485,143 @@ def generate_enum(buf: StringIO, name: str, values: dict[str, str]):
 # string as it's the only type JSON keys can use. because this is the only use case we only
 # want to convert obvious key types.
 
-def fromString(type: str, getter: str) -> str:
-    type = baseType(type)
-    if type in enums:
-        return f'{type}FromString({getter})'
-    elif type == 'String':
+def fromString(type: TypeNode, getter: str) -> str:
+    if type.kind == ENUM:
+        return f'{type.name}FromString({getter})'
+    elif type.name == 'String':
         return getter
-    elif type == 'int':
+    elif type.name == 'int':
         return f'int.parse({getter})'
     else:
-        raise TypeError(f"Can't convert {type} to string!")
+        raise TypeError(f"Can't convert {type.name} to string!")
 
-def toString(type: str, getter: str) -> str:
-    type = baseType(type)
-    if type in enums:
-        return f'{type}ToString({getter})'
-    elif type == 'String':
+def toString(type: TypeNode, getter: str) -> str:
+    if type.kind == ENUM:
+        return f'{type.name}ToString({getter})'
+    elif type.name == 'String':
         return getter
-    elif type == 'int':
+    elif type.name == 'int':
         return f'({getter}).toString()'
     else:
-        raise TypeError(f"Can't convert {type} from string!")
-
-GENERATED_ENUMS = ['APIException', 'AuthLevel']
+        raise TypeError(f"Can't convert {type.name} from string!")
 
 def fromJson(type: str, getter: str) -> str:
-    type = baseType(type)
-    if type.endswith('?'):
-        return f'(){{ final val = {getter}; return val == null ? null : {fromJson(type[:-1], "val")}; }}()'
-    elif type.startswith('List<'):
-        elementFromJson = fromJson(type[5:-1], 'element')
+    return _fromJson(resolve_type(type), getter)
+
+def toJson(type: str, getter: str) -> str:
+    return _toJson(resolve_type(type), getter)
+
+# the binary wire format is the same as JSON except classes are sent as a list of their
+# fields in schema order rather than a map, so we don't send every field name every time
+def fromWire(type: str, getter: str) -> str:
+    return _fromJson(resolve_type(type), getter, True)
+
+def toWire(type: str, getter: str) -> str:
+    return _toJson(resolve_type(type), getter, True)
+
+def _fromJson(type: TypeNode, getter: str, wire: bool = False) -> str:
+    key = (type.name, getter, wire)
+    out = _fromJsonCache.get(key)
+    if out is not None:
+        return out
+
+    if type.kind == NULLABLE:
+        out = f'(){{ final val = {getter}; return val == null ? null : {_fromJson(type.args[0], "val", wire)}; }}()'
+    elif type.kind == LIST:
+        elementFromJson = _fromJson(type.args[0], 'element', wire)
         if elementFromJson == 'element':
-            return getter
-        return f'({getter} as List<dynamic>).map((element) => {elementFromJson}).toList()'
-    elif type.startswith('Map<'):
-        keyType, valType = mapTypes(type)
-        keyFromString = fromString(keyType, 'k')
-        valFromJson = fromJson(valType, 'v')
+            out = getter
+        else:
+            out = f'({getter} as List<dynamic>).map((element) => {elementFromJson}).toList()'
+    elif type.kind == MAP:
+        keyFromString = fromString(type.args[0], 'k')
+        valFromJson = _fromJson(type.args[1], 'v', wire)
         if keyFromString == 'k' and valFromJson == 'v':
-            return getter
-        return f'({getter} as Map<String, dynamic>).map((k, v) => MapEntry({keyFromString}, {valFromJson}))'
-    elif type in enums + GENERATED_ENUMS:
-        return f'{type}.values[{getter} as int]'
-    elif type in classes:
-        return f'{type}.fromJson({getter})'
-    elif isExt(type):
-        return f'{extBase(type)}.fromJson({getter}).as{type}'
+            out = getter
+        else:
+            out = f'({getter} as Map<String, dynamic>).map((k, v) => MapEntry({keyFromString}, {valFromJson}))'
+    elif type.kind == ENUM:
+        out = f'{type.name}.values[{getter} as int]'
+    elif type.kind == CLASS:
+        out = f'{type.name}.{"fromWire" if wire else "fromJson"}({getter})'
+    elif type.kind == EXT:
+        out = f'{ext_bases[type.name]}.{"fromWire" if wire else "fromJson"}({getter}).as{type.name}'
     else:
-        return f'{getter} as {type}'
+        out = f'{getter} as {type.name}'
 
-def toJson(type: str, getter: str) -> str:
-    type = baseType(type)
-    if type.endswith('?'):
-        return f'(){{ final val = {getter}; return val == null ? null : {toJson(type[:-1], "val")}; }}()'
-    elif type.startswith('List<'):
-        elementToJson = toJson(type[5:-1], 'element')
+    _fromJsonCache[key] = out
+    return out
+
+def _toJson(type: TypeNode, getter: str, wire: bool = False) -> str:
+    key = (type.name, getter, wire)
+    out = _toJsonCache.get(key)
+    if out is not None:
+        return out
+
+    if type.kind == NULLABLE:
+        out = f'(){{ final val = {getter}; return val == null ? null : {_toJson(type.args[0], "val", wire)}; }}()'
+    elif type.kind == LIST:
+        elementToJson = _toJson(type.args[0], 'element', wire)
         if elementToJson == 'element':
-            return getter
-        return f'{getter}.map((element) => {elementToJson}).toList()'
-    elif type.startswith('Map<'):
-        keyType, valType = mapTypes(type)
-        keyToString = toString(keyType, 'k')
-        valToJson = toJson(valType, 'v')
+            out = getter
+        else:
+            out = f'{getter}.map((element) => {elementToJson}).toList()'
+    elif type.kind == MAP:
+        keyToString = toString(type.args[0], 'k')
+        valToJson = _toJson(type.args[1], 'v', wire)
         if keyToString == 'k' and valToJson == 'v':
-            return getter
-        return f'{getter}.map((k, v) => MapEntry({keyToString}, {valToJson}))'
-    elif type in enums + GENERATED_ENUMS:
-        return f'{type}.values.indexOf({getter})'
-    elif type in classes or isExt(type):
-        return f'{getter}.toJson()'
+            out = getter
+        else:
+            out = f'{getter}.map((k, v) => MapEntry({keyToString}, {valToJson}))'
+    elif type.kind == ENUM:
+        out = f'{type.name}.values.indexOf({getter})'
+    elif type.kind in (CLASS, EXT):
+        out = f'{getter}.{"toWire" if wire else "toJson"}()'
     else:
-        return getter
+        out = getter
+
+    _toJsonCache[key] = out
+    return out
+
+# a field marked `lazy List<X>` or `lazy Map<K, X>` is decoded into a LazyList/LazyMap that only
+# decodes an element the first time it's read, so a huge response only costs what's looked at
+def field_type(fieldType: str) -> tuple[str, bool]:
+    if fieldType.startswith('lazy '):
+        return fieldType[len('lazy '):].strip(), True
+    return fieldType, False
+
+def lazy_fields_used() -> bool:
+    return any(field_type(fieldType)[1] for classData in config_dict('classes').values() for fieldType in classData.values())
+
+def lazyFromJson(type: str, getter: str, wire: bool) -> str:
+    node = resolve_type(type)
+    if node.kind == NULLABLE:
+        return f'(){{ final val = {getter}; return val == null ? null : {_lazyFromJson(node.args[0], "val", wire)}; }}()'
+    return _lazyFromJson(node, getter, wire)
+
+def lazyToJson(type: str, getter: str, wire: bool) -> str:
+    node = resolve_type(type)
+    if node.kind == NULLABLE:
+        return f'(){{ final val = {getter}; return val == null ? null : {_lazyToJson(node.args[0], "val", wire)}; }}()'
+    return _lazyToJson(node, getter, wire)
+
+def _lazyFromJson(type: TypeNode, getter: str, wire: bool) -> str:
+    if type.kind == LIST:
+        element = type.args[0]
+        return f'LazyList<{element.name}>({getter} as List<dynamic>, (element) => {_fromJson(element, "element", wire)}, {str(wire).lower()})'
+    elif type.kind == MAP:
+        key, value = type.args
+        return (f'LazyMap<{key.name}, {value.name}>({getter} as Map<String, dynamic>, (k) => {fromString(key, "k")}, '
+            f'(k) => {toString(key, "k")}, (v) => {_fromJson(value, "v", wire)}, {str(wire).lower()})')
+    raise TypeError(f"Only lists and maps can be lazy, not {type.name}!")
+
+def _lazyToJson(type: TypeNode, getter: str, wire: bool) -> str:
+    if type.kind == LIST:
+        return f'_encodeLazyList({getter}, (element) => {_toJson(type.args[0], "element", wire)}, {str(wire).lower()})'
+    elif type.kind == MAP:
+        key, value = type.args
+        return f'_encodeLazyMap({getter}, (k) => {toString(key, "k")}, (v) => {_toJson(value, "v", wire)}, {str(wire).lower()})'
+    raise TypeError(f"Only lists and maps can be lazy, not {type.name}!")
 
 def generate_copywith(type: str, name: str, fields: dict[str, str], buf: StringIO):
     buf.write(f'  {type} {name}({{\n')
@@ -170,100 +643,371 @@ def generate_copywith(type: str, name: str, fields: dict[str, str], buf: StringI
         buf.write('\n')
     buf.write('  );\n')
 
-def generate_base(buf: StringIO):
-    global enums, classes, typedefs
-
-    enums = list(config_dict('enums').keys())
-    classes = list(config_dict('classes').keys())
-    typedefs = config_dict('typedefs')
-
-    for extension in list(config_dict('extensions').values()):
-        buf.write(f"import '{extension}.dart';\n")
-    
+def generate_header(buf: StringIO):
+    buf.write('\n')
+    buf.write(f'const kApiUseHttps = {str(USE_HTTPS).lower()};\n')
+    if 'compression' in config:
+        buf.write(f'const kGzipThreshold = {gzip_threshold()};\n')
+    if 'max_body_size' in config:
+        buf.write(f'const kMaxBodySize = {config["max_body_size"]};\n')
     buf.write('\n')
-    buf.write(f'const kApiUseHttps = {str(USE_HTTPS).lower()};\n\n')
 
     for typeName, typeDef in config_dict('typedefs').items():
         buf.write(f'typedef {typeName} = {typeDef};\n')
     
     buf.write('\n')
 
-    if 'auth' in config:
-        generate_enum(buf, 'AuthLevel', {v: v for v in ['Unauthorized'] + config['auth']['levels']})
+def generate_class(buf: StringIO, className: str, classData: dict[str, str]):
+    lazyFields = {fieldName for fieldName, fieldType in classData.items() if field_type(fieldType)[1]}
+    classData = {fieldName: field_type(fieldType)[0] for fieldName, fieldType in classData.items()}
+    def decode(fieldName: str, getter: str, wire: bool) -> str:
+        if fieldName in lazyFields:
+            return lazyFromJson(classData[fieldName], getter, wire)
+        return fromWire(classData[fieldName], getter) if wire else fromJson(classData[fieldName], getter)
+    def encode(fieldName: str, wire: bool) -> str:
+        if fieldName in lazyFields:
+            return lazyToJson(classData[fieldName], fieldName, wire)
+        return toWire(classData[fieldName], fieldName) if wire else toJson(classData[fieldName], fieldName)
+
+    buf.write(f'class {className} {{\n')
+
+    for fieldName, fieldType in classData.items():
+        buf.write(f'  final {fieldType} {fieldName};\n')
     
-    for enumName, enumData in config_dict('enums').items():
-        generate_enum(buf, enumName, {v: v for v in enumData})
+    buf.write(f'\n  {className}({{')
+
+    for i, fieldName in enumerate(list(classData.keys())):
+        if not classData[fieldName].endswith('?'):
+            buf.write('required ')
+        buf.write(f'this.{fieldName}')
+        if i != len(classData) - 1:
+            buf.write(', ')
     
-    for className, classData in config_dict('classes').items():
-        buf.write(f'class {className} {{\n')
+    buf.write('});\n\n')
 
-        for fieldName, fieldType in classData.items():
-            buf.write(f'  final {fieldType} {fieldName};\n')
-        
-        buf.write(f'\n  {className}({{')
+    buf.write(f'  static {className} fromJson(Map<String, dynamic> json) => {className}(\n')
 
-        for i, fieldName in enumerate(list(classData.keys())):
-            if not classData[fieldName].endswith('?'):
-                buf.write('required ')
-            buf.write(f'this.{fieldName}')
-            if i != len(classData) - 1:
-                buf.write(', ')
+    for i, fieldName in enumerate(list(classData.keys())):
+        buf.write(f'    {fieldName}: ')
+        buf.write(decode(fieldName, f"json['{fieldName}']", False))
         
-        buf.write('});\n\n')
+        if i != len(classData) - 1:
+            buf.write(',\n')
+        
+    buf.write('\n  );\n\n')
 
-        buf.write(f'  static {className} fromJson(Map<String, dynamic> json) => {className}(\n')
+    buf.write('  Map<String, dynamic> toJson() => {\n')
+    
+    for i, fieldName in enumerate(list(classData.keys())):
+        buf.write(f"    '{fieldName}': {encode(fieldName, False)}")
+        if i != len(classData) - 1:
+            buf.write(',\n')
+    
+    buf.write('\n  };\n\n')
 
+    if binary_wire():
+        buf.write(f'  static {className} fromWire(List<dynamic> wire) => {className}(\n')
         for i, fieldName in enumerate(list(classData.keys())):
-            fieldType = classData[fieldName]
-            buf.write(f'    {fieldName}: ')
-            buf.write(fromJson(fieldType, f"json['{fieldName}']"))
-            
+            buf.write(f'    {fieldName}: {decode(fieldName, f"wire[{i}]", True)}')
             if i != len(classData) - 1:
                 buf.write(',\n')
-            
         buf.write('\n  );\n\n')
 
-        buf.write('  Map<String, dynamic> toJson() => {\n')
-        
+        buf.write('  List<dynamic> toWire() => [\n')
         for i, fieldName in enumerate(list(classData.keys())):
-            fieldType = classData[fieldName]
-            buf.write(f"    '{fieldName}': {toJson(fieldType, fieldName)}")
+            buf.write(f'    {encode(fieldName, True)}')
             if i != len(classData) - 1:
                 buf.write(',\n')
+        buf.write('\n  ];\n\n')
+
+    if className in config_dict('extensions'):
+        extensionName = config['extensions'][className]
+        buf.write(f'  {extensionName} get as{extensionName} => {extensionName}(')
         
-        buf.write('\n  };\n\n')
-
-        if className in config_dict('extensions'):
-            extensionName = config['extensions'][className]
-            buf.write(f'  {extensionName} get as{extensionName} => {extensionName}(')
-            
-            for i, fieldName in enumerate(list(classData.keys())):
-                buf.write(f'{fieldName}: {fieldName}')
-                if i != len(classData) - 1:
-                    buf.write(', ')
-            
-            buf.write(');\n\n')
-
-        if className in config_dict('extensions'):
-            generate_copywith(className, 'copyBaseWith', classData, buf)
-            buf.write('\n')
-            generate_copywith(config['extensions'][className], 'copyWith', classData, buf)
-        else:
-            generate_copywith(className, 'copyWith', classData, buf)
+        for i, fieldName in enumerate(list(classData.keys())):
+            buf.write(f'{fieldName}: {fieldName}')
+            if i != len(classData) - 1:
+                buf.write(', ')
         
-        buf.write('}\n\n')
+        buf.write(');\n\n')
+
+    if className in config_dict('extensions'):
+        generate_copywith(className, 'copyBaseWith', classData, buf)
+        buf.write('\n')
+        generate_copywith(config['extensions'][className], 'copyWith', classData, buf)
+    else:
+        generate_copywith(className, 'copyWith', classData, buf)
+    
+    buf.write('}\n\n')
+
+# the views lazy fields decode into. each remembers whether its raw elements came off JSON or
+# the binary wire, and hands the raw elements that were never read straight back out when
+# encoded to the same format again - so a response that's just passed along costs nothing.
+# they're fixed length, and a bad element only throws when it's read rather than in fromJson
+def generate_lazy_collections(buf: StringIO):
+    buf.write('class LazyList<E> extends ListBase<E> {\n')
+    buf.write('  static const _undecoded = Object();\n\n')
+    buf.write('  final List<dynamic> _raw;\n')
+    buf.write('  final E Function(dynamic raw) _decode;\n')
+    buf.write('  final bool _wire;\n')
+    buf.write('  final List<Object?> _decoded;\n')
+    buf.write('  var _touched = false;\n\n')
+    buf.write('  LazyList(this._raw, this._decode, this._wire) : _decoded = List<Object?>.filled(_raw.length, _undecoded);\n\n')
+    buf.write('  @override\n')
+    buf.write('  int get length => _raw.length;\n\n')
+    buf.write('  @override\n')
+    buf.write("  set length(int newLength) => throw UnsupportedError('Lazily decoded lists have a fixed length');\n\n")
+    buf.write('  @override\n')
+    buf.write('  E operator [](int index) {\n')
+    buf.write('    final decoded = _decoded[index];\n')
+    buf.write('    if (!identical(decoded, _undecoded)) return decoded as E;\n')
+    buf.write('    _touched = true;\n')
+    buf.write('    final element = _decode(_raw[index]);\n')
+    buf.write('    _decoded[index] = element;\n')
+    buf.write('    return element;\n')
+    buf.write('  }\n\n')
+    buf.write('  @override\n')
+    buf.write('  void operator []=(int index, E value) {\n')
+    buf.write('    _touched = true;\n')
+    buf.write('    _decoded[index] = value;\n')
+    buf.write('  }\n\n')
+    buf.write('  List<dynamic> _encode(dynamic Function(E element) encode, bool wire) {\n')
+    buf.write('    if (wire == _wire && !_touched) return _raw;\n')
+    buf.write('    return [\n')
+    buf.write('      for (var i = 0; i < _raw.length; i++)\n')
+    buf.write('        wire == _wire && identical(_decoded[i], _undecoded) ? _raw[i] : encode(this[i])\n')
+    buf.write('    ];\n')
+    buf.write('  }\n')
+    buf.write('}\n\n')
+
+    # the raw collections are the decoded response itself, which the response cache and
+    # deduped calls share between callers. LazyList only ever writes to _decoded, but a map
+    # can gain and lose keys, so LazyMap copies its raw map before the first write
+    buf.write('class LazyMap<K, V> extends MapBase<K, V> {\n')
+    buf.write('  Map<String, dynamic> _raw;\n')
+    buf.write('  final K Function(String key) _decodeKey;\n')
+    buf.write('  final String Function(K key) _encodeKey;\n')
+    buf.write('  final V Function(dynamic raw) _decode;\n')
+    buf.write('  final bool _wire;\n')
+    buf.write('  final _decoded = <String, V>{};\n')
+    buf.write('  var _touched = false;\n')
+    buf.write('  var _owned = false;\n\n')
+    buf.write('  LazyMap(this._raw, this._decodeKey, this._encodeKey, this._decode, this._wire);\n\n')
+    buf.write('  V _value(String rawKey) {\n')
+    buf.write('    if (_decoded.containsKey(rawKey)) return _decoded[rawKey] as V;\n')
+    buf.write('    _touched = true;\n')
+    buf.write('    return _decoded[rawKey] = _decode(_raw[rawKey]);\n')
+    buf.write('  }\n\n')
+    buf.write('  Map<String, dynamic> get _writable {\n')
+    buf.write('    _touched = true;\n')
+    buf.write('    if (!_owned) {\n')
+    buf.write('      _raw = Map.of(_raw);\n')
+    buf.write('      _owned = true;\n')
+    buf.write('    }\n')
+    buf.write('    return _raw;\n')
+    buf.write('  }\n\n')
+    buf.write('  @override\n')
+    buf.write('  Iterable<K> get keys => _raw.keys.map(_decodeKey);\n\n')
+    buf.write('  @override\n')
+    buf.write('  int get length => _raw.length;\n\n')
+    buf.write('  @override\n')
+    buf.write('  bool containsKey(Object? key) => key is K && _raw.containsKey(_encodeKey(key));\n\n')
+    buf.write('  @override\n')
+    buf.write('  V? operator [](Object? key) {\n')
+    buf.write('    if (key is! K) return null;\n')
+    buf.write('    final rawKey = _encodeKey(key);\n')
+    buf.write('    return _raw.containsKey(rawKey) ? _value(rawKey) : null;\n')
+    buf.write('  }\n\n')
+    buf.write('  @override\n')
+    buf.write('  void operator []=(K key, V value) {\n')
+    buf.write('    final rawKey = _encodeKey(key);\n')
+    buf.write('    // the raw map is what keeps track of which keys there are\n')
+    buf.write('    _writable[rawKey] = null;\n')
+    buf.write('    _decoded[rawKey] = value;\n')
+    buf.write('  }\n\n')
+    buf.write('  @override\n')
+    buf.write('  V? remove(Object? key) {\n')
+    buf.write('    if (key is! K) return null;\n')
+    buf.write('    final rawKey = _encodeKey(key);\n')
+    buf.write('    if (!_raw.containsKey(rawKey)) return null;\n')
+    buf.write('    final value = _value(rawKey);\n')
+    buf.write('    _writable.remove(rawKey);\n')
+    buf.write('    _decoded.remove(rawKey);\n')
+    buf.write('    return value;\n')
+    buf.write('  }\n\n')
+    buf.write('  @override\n')
+    buf.write('  void clear() {\n')
+    buf.write('    _decoded.clear();\n')
+    buf.write('    // a fresh map rather than a copy that gets emptied straight away\n')
+    buf.write('    _raw = <String, dynamic>{};\n')
+    buf.write('    _owned = true;\n')
+    buf.write('    _touched = true;\n')
+    buf.write('  }\n\n')
+    buf.write('  Map<String, dynamic> _encode(dynamic Function(V value) encode, bool wire) {\n')
+    buf.write('    if (wire == _wire && !_touched) return _raw;\n')
+    buf.write('    return {\n')
+    buf.write('      for (final rawKey in _raw.keys)\n')
+    buf.write('        rawKey: wire == _wire && !_decoded.containsKey(rawKey) ? _raw[rawKey] : encode(_value(rawKey))\n')
+    buf.write('    };\n')
+    buf.write('  }\n')
+    buf.write('}\n\n')
+
+    buf.write('List<dynamic> _encodeLazyList<E>(List<E> list, dynamic Function(E element) encode, bool wire) =>\n')
+    buf.write('  list is LazyList<E> ? list._encode(encode, wire) : [for (final element in list) encode(element)];\n\n')
+    buf.write('Map<String, dynamic> _encodeLazyMap<K, V>(Map<K, V> map, String Function(K key) encodeKey, dynamic Function(V value) encode, bool wire) =>\n')
+    buf.write('  map is LazyMap<K, V> ? map._encode(encode, wire) : {for (final entry in map.entries) encodeKey(entry.key): encode(entry.value)};\n\n')
+
+# just enough MessagePack to carry what toWire() produces, so the generated code doesn't
+# need any dependencies beyond what it already has
+def generate_msgpack(buf: StringIO):
+    buf.write('class MsgPack {\n')
+    buf.write("  static const mimeType = 'application/msgpack';\n\n")
+    buf.write('  static Uint8List encode(Object? value) {\n')
+    buf.write('    final out = BytesBuilder(copy: false);\n')
+    buf.write('    _write(out, value);\n')
+    buf.write('    return out.takeBytes();\n')
+    buf.write('  }\n\n')
+    buf.write('  static dynamic decode(Uint8List bytes) => _MsgPackReader(bytes).read();\n\n')
+    buf.write('  static void _writeLength(BytesBuilder out, int length, int fix, int fixMax, int long) {\n')
+    buf.write('    if (length <= fixMax) {\n')
+    buf.write('      out.addByte(fix | length);\n')
+    buf.write('    } else {\n')
+    buf.write('      out.addByte(long);\n')
+    buf.write('      out.add((ByteData(4)..setUint32(0, length)).buffer.asUint8List());\n')
+    buf.write('    }\n')
+    buf.write('  }\n\n')
+    buf.write('  static void _write(BytesBuilder out, Object? value) {\n')
+    buf.write('    if (value == null) {\n')
+    buf.write('      out.addByte(0xc0);\n')
+    buf.write('    } else if (value is bool) {\n')
+    buf.write('      out.addByte(value ? 0xc3 : 0xc2);\n')
+    buf.write('    } else if (value is int) {\n')
+    buf.write('      if (value >= -32 && value <= 127) {\n')
+    buf.write('        out.addByte(value & 0xff);\n')
+    buf.write('      } else if (value >= -0x80000000 && value <= 0x7fffffff) {\n')
+    buf.write('        out.addByte(0xd2);\n')
+    buf.write('        out.add((ByteData(4)..setInt32(0, value)).buffer.asUint8List());\n')
+    buf.write('      } else {\n')
+    buf.write('        out.addByte(0xd3);\n')
+    buf.write('        out.add((ByteData(8)..setInt64(0, value)).buffer.asUint8List());\n')
+    buf.write('      }\n')
+    buf.write('    } else if (value is double) {\n')
+    buf.write('      out.addByte(0xcb);\n')
+    buf.write('      out.add((ByteData(8)..setFloat64(0, value)).buffer.asUint8List());\n')
+    buf.write('    } else if (value is String) {\n')
+    buf.write('      final bytes = utf8.encode(value);\n')
+    buf.write('      _writeLength(out, bytes.length, 0xa0, 31, 0xdb);\n')
+    buf.write('      out.add(bytes);\n')
+    buf.write('    } else if (value is List) {\n')
+    buf.write('      _writeLength(out, value.length, 0x90, 15, 0xdd);\n')
+    buf.write('      for (final element in value) { _write(out, element); }\n')
+    buf.write('    } else if (value is Map) {\n')
+    buf.write('      _writeLength(out, value.length, 0x80, 15, 0xdf);\n')
+    buf.write('      value.forEach((k, v) {\n')
+    buf.write('        _write(out, k);\n')
+    buf.write('        _write(out, v);\n')
+    buf.write('      });\n')
+    buf.write('    } else {\n')
+    buf.write("      throw ArgumentError('Can\\'t encode ${value.runtimeType} as MessagePack');\n")
+    buf.write('    }\n')
+    buf.write('  }\n')
+    buf.write('}\n\n')
+
+    buf.write('class _MsgPackReader {\n')
+    buf.write('  final ByteData _data;\n')
+    buf.write('  int _offset = 0;\n\n')
+    buf.write('  _MsgPackReader(Uint8List bytes) : _data = ByteData.sublistView(bytes);\n\n')
+    buf.write('  int _take(int length) {\n')
+    buf.write('    final offset = _offset;\n')
+    buf.write('    _offset += length;\n')
+    buf.write('    return offset;\n')
+    buf.write('  }\n\n')
+    buf.write('  String _string(int length) => utf8.decode(Uint8List.sublistView(_data, _take(length), _offset));\n')
+    buf.write('  List<dynamic> _list(int length) => List<dynamic>.generate(length, (_) => read());\n')
+    buf.write('  Map<String, dynamic> _map(int length) {\n')
+    buf.write('    final out = <String, dynamic>{};\n')
+    buf.write('    for (var i = 0; i < length; i++) {\n')
+    buf.write('      final key = read() as String;\n')
+    buf.write('      out[key] = read();\n')
+    buf.write('    }\n')
+    buf.write('    return out;\n')
+    buf.write('  }\n\n')
+    buf.write('  dynamic read() {\n')
+    buf.write('    final byte = _data.getUint8(_take(1));\n')
+    buf.write('    if (byte <= 0x7f) return byte;\n')
+    buf.write('    if (byte >= 0xe0) return byte - 0x100;\n')
+    buf.write('    if (byte & 0xe0 == 0xa0) return _string(byte & 0x1f);\n')
+    buf.write('    if (byte & 0xf0 == 0x90) return _list(byte & 0x0f);\n')
+    buf.write('    if (byte & 0xf0 == 0x80) return _map(byte & 0x0f);\n')
+    buf.write('    switch (byte) {\n')
+    buf.write('      case 0xc0: return null;\n')
+    buf.write('      case 0xc2: return false;\n')
+    buf.write('      case 0xc3: return true;\n')
+    buf.write('      case 0xc4: return Uint8List.fromList(Uint8List.sublistView(_data, _take(_data.getUint8(_take(1))), _offset));\n')
+    buf.write('      case 0xc5: return Uint8List.fromList(Uint8List.sublistView(_data, _take(_data.getUint16(_take(2))), _offset));\n')
+    buf.write('      case 0xc6: return Uint8List.fromList(Uint8List.sublistView(_data, _take(_data.getUint32(_take(4))), _offset));\n')
+    buf.write('      case 0xca: return _data.getFloat32(_take(4));\n')
+    buf.write('      case 0xcb: return _data.getFloat64(_take(8));\n')
+    buf.write('      case 0xcc: return _data.getUint8(_take(1));\n')
+    buf.write('      case 0xcd: return _data.getUint16(_take(2));\n')
+    buf.write('      case 0xce: return _data.getUint32(_take(4));\n')
+    buf.write('      case 0xcf: return _data.getUint64(_take(8));\n')
+    buf.write('      case 0xd0: return _data.getInt8(_take(1));\n')
+    buf.write('      case 0xd1: return _data.getInt16(_take(2));\n')
+    buf.write('      case 0xd2: return _data.getInt32(_take(4));\n')
+    buf.write('      case 0xd3: return _data.getInt64(_take(8));\n')
+    buf.write('      case 0xd9: return _string(_data.getUint8(_take(1)));\n')
+    buf.write('      case 0xda: return _string(_data.getUint16(_take(2)));\n')
+    buf.write('      case 0xdb: return _string(_data.getUint32(_take(4)));\n')
+    buf.write('      case 0xdc: return _list(_data.getUint16(_take(2)));\n')
+    buf.write('      case 0xdd: return _list(_data.getUint32(_take(4)));\n')
+    buf.write('      case 0xde: return _map(_data.getUint16(_take(2)));\n')
+    buf.write('      case 0xdf: return _map(_data.getUint32(_take(4)));\n')
+    buf.write('      default: throw FormatException(\'Unsupported MessagePack type 0x${byte.toRadixString(16)}\');\n')
+    buf.write('    }\n')
+    buf.write('  }\n')
+    buf.write('}\n\n')
+
+def generate_base(buf: Chunk):
+    section(buf, 'header', None, generate_header)
+
+    if 'auth' in config:
+        authLevels = {v: v for v in ['Unauthorized'] + config['auth']['levels']}
+        section(buf, 'enum AuthLevel', authLevels, lambda buf: generate_enum(buf, 'AuthLevel', authLevels))
+    
+    for enumName, enumData in config_dict('enums').items():
+        section(buf, f'enum {enumName}', enumData, lambda buf: generate_enum(buf, enumName, {v: v for v in enumData}))
+    
+    for className, classData in config_dict('classes').items():
+        section(buf, f'class {className}', classData, lambda buf: generate_class(buf, className, classData))
 
     exceptions = {exception.title().replace(' ', ''): exception for exception in
         ['Success', 'Unsupported method', 'Unsupported endpoint', 'Object format error', 'Internal error', 'Unauthorized'] + config_list('exceptions')
     }
-    generate_enum(buf, 'APIException', exceptions)
+    section(buf, 'enum APIException', exceptions, lambda buf: generate_enum(buf, 'APIException', exceptions))
+
+    if binary_wire():
+        section(buf, 'msgpack', None, generate_msgpack)
 
+    if lazy_fields_used():
+        section(buf, 'lazy collections', None, generate_lazy_collections)
 
-def generate_server(buf: StringIO):
+
+# async handlers get FutureOr so a handler that never actually waits on anything can still
+# just return its result
+def handler_type(type: str, isAsync: bool) -> str:
+    return f'FutureOr<{type}>' if isAsync else type
+
+def handler_out(endpointType: dict[str, Any]) -> str:
+    if endpointType.get('stream', False):
+        return f'Stream<{endpointType["out"]}>'
+    return handler_type(endpointType.get('out', 'void'), handler_async(endpointType))
+
+def generate_handler_interfaces(buf: StringIO):
     buf.write('abstract class APIHandler {\n')
     for endpointName, endpointType in config_dict('endpoints').items():
         if endpointType.get('handledBy', 'main') != 'main': continue
-        buf.write(f'  {endpointType.get("out", "void")} {endpointName}(')
+        buf.write(f'  {handler_out(endpointType)} {endpointName}(')
         if endpointType.get('forwardToken', False):
             buf.write(f'{config["auth"]["out"]} token')
             if 'in' in endpointType:
@@ -275,12 +1019,12 @@ def generate_server(buf: StringIO):
 
     if 'auth' in config:
         buf.write('abstract class AuthHandler {\n')
-        buf.write(f'  {config["auth"]["out"]} generateToken({config["auth"]["in"]} credentials);\n')
-        buf.write(f'  AuthLevel validateToken({config["auth"]["out"]} token);\n\n')
+        buf.write(f'  {handler_type(config["auth"]["out"], auth_async())} generateToken({config["auth"]["in"]} credentials);\n')
+        buf.write(f'  {handler_type("AuthLevel", auth_async())} validateToken({config["auth"]["out"]} token);\n\n')
         
         for endpointName, endpointType in config_dict('endpoints').items():
             if endpointType.get('handledBy', 'main') == 'auth':
-                buf.write(f'  {endpointType.get("out", "void")} {endpointName}(')
+                buf.write(f'  {handler_out(endpointType)} {endpointName}(')
                 if endpointType.get('forwardToken', False):
                     buf.write(f'{config["auth"]["out"]} token')
                     if 'in' in endpointType:
@@ -290,128 +1034,905 @@ def generate_server(buf: StringIO):
                 buf.write(');\n')
 
             if endpointType.get('authLevel', '') == 'Custom':
-                buf.write(f'  bool {endpointName}Auth({config["auth"]["out"]} token')
+                buf.write(f'  {handler_type("bool", handler_async(endpointType))} {endpointName}Auth({config["auth"]["out"]} token')
                 if 'in' in endpointType:
                     buf.write(f', {endpointType["in"]} request')
                 buf.write(');\n')
 
 
         buf.write('}\n\n')
-        config['endpoints']['_authorize'] = config['auth']
 
+# invalidatesToken marks logout-ish endpoints - the token they're called with gets dropped
+# from the token cache once the handler's done with it
+def sends_token(endpointType: dict[str, Any]) -> bool:
+    return 'authLevel' in endpointType or endpointType.get('forwardToken', False) or endpointType.get('invalidatesToken', False)
+
+def takes_body(endpointType: dict[str, Any]) -> bool:
+    return 'in' in endpointType or sends_token(endpointType)
+
+def auth_config() -> dict[str, Any]:
+    return config.get('auth') or {}
+
+def token_cache_enabled() -> bool:
+    return 'cache' in auth_config()
+
+# async: true at the top of the schema makes every handler async, on an endpoint it's just
+# that one (and its Custom auth check). async: true in the auth section covers generateToken
+# and validateToken, so they can go off and talk to a user store without blocking everything
+# else
+def handler_async(endpointType: dict[str, Any]) -> bool:
+    return endpointType.get('async', config.get('async', False))
+
+def auth_async() -> bool:
+    return auth_config().get('async', config.get('async', False))
+
+# anything that has to wait on a handler or on validateToken has to be async itself
+def endpoint_async(endpointType: dict[str, Any]) -> bool:
+    return handler_async(endpointType) or (auth_async() and endpointType.get('authLevel', 'Custom') != 'Custom')
+
+# cache: {ttl, size} on an endpoint keeps its responses around for ttl seconds. the server
+# holds on to the encoded bytes and hands out ETags, the frontend keeps its own copy and
+# revalidates it with If-None-Match once it's gone stale
+def endpoint_cache(endpointName: str, endpointType: dict[str, Any]) -> Optional[dict[str, Any]]:
+    # _authorize is the auth section, where cache means the token cache - its responses are
+    # fresh tokens every time, so never keep those around
+    if endpointName == '_authorize' or 'cache' not in endpointType:
+        return None
+    if 'out' not in endpointType:
+        raise ValueError(f"Endpoint '{endpointName}' has nothing to cache without an out type!")
+    return endpointType['cache'] or {}
+
+def cached_endpoints() -> dict[str, dict[str, Any]]:
+    return {endpointName: endpoint_cache(endpointName, endpointType)
+        for endpointName, endpointType in config_dict('endpoints').items() if 'cache' in endpointType}
+
+def response_cache(endpointName: str) -> str:
+    return f'_{endpointName}Cache'
+
+# stream: true endpoints have their handler return a Stream<Out>, which goes out as one line
+# of JSON per item followed by a line with the code, and comes out of the frontend as a
+# Stream<Out> again - so a big export never has to be in memory all at once on either end
+def endpoint_stream(endpointName: str, endpointType: dict[str, Any]) -> bool:
+    if not endpointType.get('stream', False):
+        return False
+    if 'out' not in endpointType:
+        raise ValueError(f"Endpoint '{endpointName}' has nothing to stream without an out type!")
+    if 'cache' in endpointType:
+        raise ValueError(f"Endpoint '{endpointName}' can't be streamed and cached!")
+    return True
+
+def streamed_endpoints() -> list[str]:
+    return [endpointName for endpointName, endpointType in all_endpoints().items() if endpoint_stream(endpointName, endpointType)]
+
+def handler_return(isAsync: bool) -> str:
+    return 'Future<Map<String, dynamic>>' if isAsync else 'Map<String, dynamic>'
+
+def await_if(isAsync: bool) -> str:
+    return 'await ' if isAsync else ''
+
+def handler_function(endpointName: str) -> str:
+    return f'_handle{endpointName[0].upper()}{endpointName[1:]}'
+
+# the endpoint functions need to know which format to decode/encode when we're accepting
+# both JSON and MessagePack
+def handler_params() -> str:
+    params = 'dynamic reqBody, APIHandler handler, AuthHandler auth'
+    if binary_wire():
+        params += ', bool binary'
+    if metrics_enabled():
+        params += ', RequestSample sample'
+    return params
+
+def handler_args(reqBody: str) -> str:
+    args = f'{reqBody}, handler, auth'
+    if binary_wire():
+        args += ', binary'
+    if metrics_enabled():
+        args += ', sample'
+    return args
+
+def respond(response: str, binary: bool = False) -> str:
+    args = 'request, sample' if metrics_enabled() else 'request'
+    args += f', {response}'
+    if binary and binary_wire():
+        args += ', binary'
+    return f'_respond({args});\n'
+
+def generate_logger(buf: StringIO):
+    buf.write(f'enum LogLevel {{ {", ".join(LOG_LEVELS)} }}\n\n')
+    buf.write('// anything at or above logLevel goes to logSink, LogLevel.off turns it all off\n')
+    buf.write(f'LogLevel logLevel = LogLevel.{log_level()};\n')
+    buf.write('void Function(LogLevel level, String message) logSink = (level, message) => print(message);\n\n')
+
+# every request gets a RequestSample that follows it through decode -> auth -> handler ->
+# encode and gets handed to metricsSink once the response is written. InMemoryMetrics keeps
+# running totals per endpoint and is what /_metrics serves, if that's turned on
+def generate_metrics(buf: StringIO):
+    buckets = metrics_config().get('buckets', [100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000, 1000000])
+    buf.write('// latency bucket upper bounds in microseconds, anything slower lands in the last one\n')
+    buf.write(f'const kLatencyBuckets = <int>[{", ".join(str(bucket) for bucket in buckets)}];\n\n')
+
+    buf.write('class LatencyHistogram {\n')
+    buf.write('  final counts = List<int>.filled(kLatencyBuckets.length + 1, 0);\n')
+    buf.write('  int count = 0;\n')
+    buf.write('  int totalMicros = 0;\n\n')
+    buf.write('  void record(int micros) {\n')
+    buf.write('    var bucket = 0;\n')
+    buf.write('    while (bucket < kLatencyBuckets.length && micros > kLatencyBuckets[bucket]) bucket++;\n')
+    buf.write('    counts[bucket]++;\n')
+    buf.write('    count++;\n')
+    buf.write('    totalMicros += micros;\n')
+    buf.write('  }\n\n')
+    buf.write('  Map<String, dynamic> toJson() => {\n')
+    buf.write("    'count': count,\n")
+    buf.write("    'totalMicros': totalMicros,\n")
+    buf.write("    'buckets': {for (var i = 0; i < kLatencyBuckets.length; i++) '${kLatencyBuckets[i]}': counts[i], 'inf': counts.last}\n")
+    buf.write('  };\n')
+    buf.write('}\n\n')
+
+    buf.write('class RequestSample {\n')
+    buf.write('  final String endpoint;\n')
+    buf.write('  final _clock = Stopwatch()..start();\n')
+    buf.write('  int decodeMicros = 0;\n')
+    buf.write('  int authMicros = 0;\n')
+    buf.write('  int handlerMicros = 0;\n')
+    buf.write('  int encodeMicros = 0;\n')
+    buf.write('  int bytesIn = 0;\n')
+    buf.write('  int bytesOut = 0;\n')
+    buf.write('  int code = 0;\n\n')
+    buf.write('  RequestSample(this.endpoint);\n\n')
+    buf.write('  // microseconds since the last lap\n')
+    buf.write('  int lap() {\n')
+    buf.write('    final micros = _clock.elapsedMicroseconds;\n')
+    buf.write('    _clock.reset();\n')
+    buf.write('    return micros;\n')
+    buf.write('  }\n')
+    buf.write('}\n\n')
+
+    buf.write('abstract class MetricsSink {\n')
+    buf.write('  void record(RequestSample sample);\n')
+    buf.write('}\n\n')
+
+    buf.write('class EndpointMetrics {\n')
+    buf.write('  int requests = 0;\n')
+    buf.write('  int bytesIn = 0;\n')
+    buf.write('  int bytesOut = 0;\n')
+    buf.write('  final decode = LatencyHistogram();\n')
+    buf.write('  final auth = LatencyHistogram();\n')
+    buf.write('  final handler = LatencyHistogram();\n')
+    buf.write('  final encode = LatencyHistogram();\n')
+    buf.write('  final codes = List<int>.filled(APIException.values.length, 0);\n\n')
+    buf.write('  void record(RequestSample sample) {\n')
+    buf.write('    requests++;\n')
+    buf.write('    bytesIn += sample.bytesIn;\n')
+    buf.write('    bytesOut += sample.bytesOut;\n')
+    buf.write('    decode.record(sample.decodeMicros);\n')
+    buf.write('    auth.record(sample.authMicros);\n')
+    buf.write('    handler.record(sample.handlerMicros);\n')
+    buf.write('    encode.record(sample.encodeMicros);\n')
+    buf.write('    codes[sample.code]++;\n')
+    buf.write('  }\n\n')
+    buf.write('  Map<String, dynamic> toJson() => {\n')
+    buf.write("    'requests': requests,\n")
+    buf.write("    'bytesIn': bytesIn,\n")
+    buf.write("    'bytesOut': bytesOut,\n")
+    buf.write("    'decode': decode.toJson(),\n")
+    buf.write("    'auth': auth.toJson(),\n")
+    buf.write("    'handler': handler.toJson(),\n")
+    buf.write("    'encode': encode.toJson(),\n")
+    buf.write("    'codes': {for (var i = 0; i < codes.length; i++) if (codes[i] > 0) APIExceptionToString(APIException.values[i]): codes[i]}\n")
+    buf.write('  };\n')
+    buf.write('}\n\n')
+
+    # only known paths get their own entry, otherwise anyone could grow the map forever
+    endpoints = [f'/{endpointName}' for endpointName in all_endpoints()]
+    if config.get('batch', False):
+        endpoints.append('/_batch')
+    buf.write('class InMemoryMetrics implements MetricsSink {\n')
+    buf.write('  final endpoints = <String, EndpointMetrics>{\n')
+    for endpoint in endpoints + ['other']:
+        buf.write(f"    '{endpoint}': EndpointMetrics(),\n")
+    buf.write('  };\n\n')
+    buf.write('  @override\n')
+    buf.write("  void record(RequestSample sample) => (endpoints[sample.endpoint] ?? endpoints['other']!).record(sample);\n\n")
+    buf.write('  Map<String, dynamic> toJson() => {for (final entry in endpoints.entries) entry.key: entry.value.toJson()};\n')
+    buf.write('}\n\n')
+
+    buf.write('final inMemoryMetrics = InMemoryMetrics();\n')
+    buf.write('MetricsSink metricsSink = inMemoryMetrics;\n\n')
+
+    # the streaming encoder never hands us the whole body, so count it on the way past
+    buf.write('class _CountingSink implements Sink<List<int>> {\n')
+    buf.write('  final Sink<List<int>> _inner;\n')
+    buf.write('  final RequestSample _sample;\n\n')
+    buf.write('  _CountingSink(this._inner, this._sample);\n\n')
+    buf.write('  @override\n')
+    buf.write('  void add(List<int> chunk) {\n')
+    buf.write('    _sample.bytesOut += chunk.length;\n')
+    buf.write('    _inner.add(chunk);\n')
+    buf.write('  }\n\n')
+    buf.write('  @override\n')
+    buf.write('  void close() => _inner.close();\n')
+    buf.write('}\n\n')
+
+def generate_request_helpers(buf: StringIO):
+    if 'max_body_size' in config:
+        buf.write('class _BodyTooLarge implements Exception {\n')
+        buf.write('  const _BodyTooLarge();\n')
+        buf.write('}\n\n')
+        # content-length gets checked up front, this is for chunked bodies that don't have one
+        buf.write('Stream<List<int>> _limitBody(Stream<List<int>> body) {\n')
+        buf.write('  var size = 0;\n')
+        buf.write('  return body.map((chunk) {\n')
+        buf.write('    size += chunk.length;\n')
+        buf.write('    if (size > kMaxBodySize) throw const _BodyTooLarge();\n')
+        buf.write('    return chunk;\n')
+        buf.write('  });\n')
+        buf.write('}\n\n')
+
+    if 'compression' in config:
+        # Accept-Encoding is a list of codings with optional q-values. gzip;q=0 turns gzip off,
+        # and * stands in for gzip unless gzip's listed itself
+        buf.write('bool _acceptsGzip(HttpRequest request) {\n')
+        buf.write('  double? gzip;\n')
+        buf.write('  double? any;\n')
+        buf.write('  for (final header in request.headers[HttpHeaders.acceptEncodingHeader] ?? const <String>[]) {\n')
+        buf.write("    for (final coding in header.split(',')) {\n")
+        buf.write("      final params = coding.split(';');\n")
+        buf.write('      final name = params.first.trim().toLowerCase();\n')
+        buf.write('      var q = 1.0;\n')
+        buf.write('      for (final param in params.skip(1)) {\n')
+        buf.write("        final parts = param.split('=');\n")
+        buf.write("        if (parts.length == 2 && parts[0].trim().toLowerCase() == 'q') q = double.tryParse(parts[1].trim()) ?? 0;\n")
+        buf.write('      }\n')
+        buf.write("      if (name == 'gzip' || name == 'x-gzip') {\n")
+        buf.write('        gzip = q;\n')
+        buf.write("      } else if (name == '*') {\n")
+        buf.write('        any = q;\n')
+        buf.write('      }\n')
+        buf.write('    }\n')
+        buf.write('  }\n')
+        buf.write('  return (gzip ?? any ?? 0) > 0;\n')
+        buf.write('}\n\n')
+
+    respondParams = 'HttpRequest request, RequestSample sample' if metrics_enabled() else 'HttpRequest request'
+    if binary_wire():
+        buf.write(f'void _respond({respondParams}, Map<String, dynamic> response, [bool binary = false]) {{\n')
+        buf.write("  request.response.headers.contentType = binary ? ContentType('application', 'msgpack') : ContentType.json;\n")
+    else:
+        buf.write(f'void _respond({respondParams}, Map<String, dynamic> response) {{\n')
+        buf.write('  request.response.headers.contentType = ContentType.json;\n')
+
+    metricsTail = ''
+    if metrics_enabled():
+        # toJson on the handler's result happens before we get here, so it counts as encoding too
+        metricsTail += '  sample.encodeMicros += sample.lap();\n'
+        metricsTail += "  sample.code = response['code'];\n"
+        metricsTail += '  metricsSink.record(sample);\n'
+
+    if cached_endpoints():
+        buf.write('  final cached = _cachedResponses[response];\n')
+        buf.write('  if (cached != null) {\n')
+        respondArgs = 'request, cached, binary' if binary_wire() else 'request, cached'
+        if metrics_enabled():
+            respondArgs += ', sample'
+        buf.write(f'    _respondCached({respondArgs});\n')
+        buf.write(''.join('  ' + line + '\n' for line in metricsTail.splitlines()))
+        buf.write('    return;\n')
+        buf.write('  }\n')
+
+    if 'compression' in config:
+        # have to know how big it is to know whether to compress it, so no streaming here
+        if binary_wire():
+            buf.write('  final bytes = binary ? MsgPack.encode(response) : const JsonUtf8Encoder().convert(response);\n')
+        else:
+            buf.write('  final bytes = const JsonUtf8Encoder().convert(response);\n')
+        buf.write('  if (bytes.length >= kGzipThreshold && _acceptsGzip(request)) {\n')
+        buf.write("    request.response.headers.set(HttpHeaders.contentEncodingHeader, 'gzip');\n")
+        if metrics_enabled():
+            buf.write('    final gzipped = gzip.encode(bytes);\n')
+            buf.write('    sample.bytesOut = gzipped.length;\n')
+            buf.write('    request.response.add(gzipped);\n')
+        else:
+            buf.write('    request.response.add(gzip.encode(bytes));\n')
+        buf.write('  } else {\n')
+        if metrics_enabled():
+            buf.write('    sample.bytesOut = bytes.length;\n')
+        buf.write('    request.response.add(bytes);\n')
+        buf.write('  }\n')
+        buf.write('  request.response.close();\n')
+    else:
+        if binary_wire():
+            buf.write('  if (binary) {\n')
+            if metrics_enabled():
+                buf.write('    final bytes = MsgPack.encode(response);\n')
+                buf.write('    sample.bytesOut = bytes.length;\n')
+                buf.write('    request.response.add(bytes);\n')
+                buf.write('    request.response.close();\n')
+                buf.write('  } else {\n')
+                buf.write('    const JsonUtf8Encoder().startChunkedConversion(_CountingSink(request.response, sample))\n')
+                buf.write('      ..add(response)\n')
+                buf.write('      ..close();\n')
+                buf.write('  }\n')
+            else:
+                buf.write('    request.response.add(MsgPack.encode(response));\n')
+                buf.write('    request.response.close();\n')
+                buf.write('    return;\n')
+                buf.write('  }\n')
+        # straight into the response as utf8 without ever building the whole thing as a String.
+        # closing the encoder closes the response
+        if metrics_enabled() and not binary_wire():
+            buf.write('  const JsonUtf8Encoder().startChunkedConversion(_CountingSink(request.response, sample))\n')
+            buf.write('    ..add(response)\n')
+            buf.write('    ..close();\n')
+        elif not metrics_enabled():
+            buf.write('  const JsonUtf8Encoder().startChunkedConversion(request.response)\n')
+            buf.write('    ..add(response)\n')
+            buf.write('    ..close();\n')
+    buf.write(metricsTail)
+    buf.write('}\n\n')
+
+    if streamed_endpoints():
+        generate_respond_stream(buf)
+
+# always JSON whatever the request came in as, since it's read a line at a time. waiting on
+# the client every kStreamFlushSize bytes stops a fast handler running away from a slow client
+def generate_respond_stream(buf: StringIO):
+    buf.write('const kStreamFlushSize = 16 * 1024;\n\n')
+    if metrics_enabled():
+        buf.write('Future<void> _respondStream(HttpRequest request, RequestSample sample, Stream<dynamic> items) async {\n')
+    else:
+        buf.write('Future<void> _respondStream(HttpRequest request, Stream<dynamic> items) async {\n')
+    buf.write("  request.response.headers.contentType = ContentType('application', 'x-ndjson', charset: 'utf-8');\n")
+    buf.write('  var code = APIException.values.indexOf(APIException.Success);\n')
+    buf.write('  var unflushed = 0;\n')
+    buf.write('  try {\n')
+    buf.write('    await for (final item in items) {\n')
+    buf.write("      final line = const JsonUtf8Encoder().convert({'data': item});\n")
+    buf.write('      request.response\n')
+    buf.write('        ..add(line)\n')
+    buf.write('        ..add(const [10]);\n')
+    if metrics_enabled():
+        buf.write('      sample.bytesOut += line.length + 1;\n')
+    buf.write('      unflushed += line.length + 1;\n')
+    buf.write('      if (unflushed >= kStreamFlushSize) {\n')
+    buf.write('        unflushed = 0;\n')
+    buf.write('        await request.response.flush();\n')
+    buf.write('      }\n')
+    buf.write('    }\n')
+    buf.write('  } on APIException catch (e, t) {\n')
+    buf.write('    ' + log('info', "'Handled APIException:\\n$e\\n$t'"))
+    buf.write('    code = APIException.values.indexOf(e);\n')
+    buf.write('  } catch (e, t) {\n')
+    buf.write('    ' + log('error', "'Unhandled exception from API stream:\\n$e\\n$t'"))
+    buf.write('    code = APIException.values.indexOf(APIException.InternalError);\n')
+    buf.write('  }\n')
+    buf.write("  final trailer = const JsonUtf8Encoder().convert({'code': code});\n")
+    buf.write('  request.response\n')
+    buf.write('    ..add(trailer)\n')
+    buf.write('    ..add(const [10]);\n')
+    buf.write('  await request.response.close();\n')
+    if metrics_enabled():
+        # producing the items and encoding them are all mixed up together, so it all counts as handler time
+        buf.write('  sample.handlerMicros += sample.lap();\n')
+        buf.write('  sample.bytesOut += trailer.length + 1;\n')
+        buf.write('  sample.code = code;\n')
+        buf.write('  metricsSink.record(sample);\n')
+    buf.write('}\n\n')
+
+# each endpoint gets its own function from decoded request body -> response object, so the
+# same code can serve a plain request or one entry out of a batch
+def generate_request_endpoint(buf: StringIO, endpointName: str, endpointType: dict[str, Any]):
+    buf.write(f'// {endpointType}\n')
+    isAsync = endpoint_async(endpointType)
+    buf.write(f'{handler_return(isAsync)} {handler_function(endpointName)}({handler_params()}) {"async " if isAsync else ""}{{\n')
+    if takes_body(endpointType):
+        if 'in' in endpointType:
+            buf.write(f'  final {endpointType.get("in", "void")} reqData;\n')
+        if sends_token(endpointType):
+            buf.write(f'  final {config["auth"]["out"]} token;\n')
+        buf.write('  try {\n')
+        if 'in' in endpointType:
+            reqBodyData = "reqBody['data']"
+            reqDataGetter = fromJson(endpointType['in'], reqBodyData)
+            reqWireGetter = fromWire(endpointType['in'], reqBodyData) if binary_wire() else reqDataGetter
+            # enums, primitives and the like read the same off either wire
+            if reqWireGetter != reqDataGetter:
+                reqDataGetter = f'binary ? {reqWireGetter} : {reqDataGetter}'
+            buf.write(f"    reqData = {reqDataGetter};\n")
+        if sends_token(endpointType):
+            buf.write(f"    token = reqBody['token'];\n")
+        buf.write('  } catch (e, t) {\n')
+        buf.write('    ' + log('warning', "'Object format error:\\n$e\\n$t'"))
+        buf.write("    return {'code': APIException.values.indexOf(APIException.ObjectFormatError)};\n")
+        buf.write('  }\n\n')
+    if metrics_enabled():
+        buf.write('  sample.decodeMicros += sample.lap();\n')
+    buf.write('  try {\n')
+
+    if 'authLevel' in endpointType:
+        if endpointType['authLevel'] == 'Custom':
+            if handler_async(endpointType):
+                buf.write(f'    if (!(await auth.{endpointName}Auth(token')
+            else:
+                buf.write(f'    if (!auth.{endpointName}Auth(token')
+            if 'in' in endpointType:
+                buf.write(', reqData')
+            buf.write('))) {\n' if handler_async(endpointType) else ')) {\n')
+        else:
+            validator = '_validateToken(auth, token)' if token_cache_enabled() else 'auth.validateToken(token)'
+            buf.write(f'    final tokenLevel = {await_if(auth_async())}{validator};\n')
+            buf.write(f'    if (AuthLevel.values.indexOf(tokenLevel) < AuthLevel.values.indexOf(AuthLevel.{endpointType["authLevel"]})) {{\n')
+        buf.write("      return {'code': APIException.values.indexOf(APIException.Unauthorized)};\n")
+        buf.write('    }\n')
+        if metrics_enabled():
+            buf.write('    sample.authMicros += sample.lap();\n')
+        buf.write('\n')
+
+    if endpointName == '_authorize':
+        responseGetter = f'auth.generateToken('
+    elif endpointType.get('handledBy', 'main') == 'main':
+        responseGetter = f'handler.{endpointName}('
+    elif endpointType.get('handledBy', 'main') == 'auth':
+        responseGetter = f'auth.{endpointName}('
+    else:
+        raise ValueError(f"Unknown request handler '{endpointType.get('handledBy', 'main')}'!")
+
+    if endpointType.get('forwardToken', False):
+        responseGetter += 'token'
+        if 'in' in endpointType:
+            responseGetter += ', '
+
+    if 'in' in endpointType:
+        responseGetter += 'reqData'
+    
+    responseGetter += ')'
+    stream = endpoint_stream(endpointName, endpointType)
+    if handler_async(endpointType) and not stream:
+        responseGetter = f'await {responseGetter}'
+
+    cache = endpoint_cache(endpointName, endpointType)
+    if cache is not None:
+        # whatever the handler's output can depend on, plus the format it's going out in
+        keyParts = []
+        if binary_wire():
+            keyParts.append('$binary')
+        if endpointType.get('authLevel', 'Custom') != 'Custom':
+            keyParts.append('${tokenLevel.index}')
+        if endpointType.get('forwardToken', False):
+            keyParts.append('${json.encode(token)}')
+        if 'in' in endpointType:
+            keyParts.append(f'${{json.encode({toJson(endpointType["in"], "reqData")})}}')
+        buf.write(f"    final cacheKey = '{' '.join(keyParts)}';\n")
+        buf.write(f'    final cached = {response_cache(endpointName)}.lookup(cacheKey);\n')
+        buf.write('    if (cached != null) return cached;\n\n')
+
+    handlerLap = '    sample.handlerMicros += sample.lap();\n' if metrics_enabled() else ''
+    if endpointType.get('invalidatesToken', False) and token_cache_enabled():
+        handlerLap += '    invalidateToken(token);\n'
+    if stream:
+        # _respondStream does the actual sending once it sees there's a stream in the response
+        buf.write(f'    final out = {responseGetter};\n')
+        buf.write(handlerLap)
+        itemData = toJson(endpointType['out'], 'item')
+        items = 'out' if itemData == 'item' else f'out.map((item) => {itemData})'
+        buf.write(f"    return {{'stream': {items}, 'code': APIException.values.indexOf(APIException.Success)}};\n")
+    elif 'out' in endpointType:
+        outValue = responseGetter
+        outWire = toWire(endpointType['out'], 'out') if binary_wire() else None
+        if outWire == toJson(endpointType['out'], 'out'):
+            outWire = None
+        if handlerLap or outWire is not None or handler_async(endpointType):
+            buf.write(f'    final out = {responseGetter};\n')
+            buf.write(handlerLap)
+            outValue = 'out'
+        outData = toJson(endpointType['out'], outValue)
+        if outWire is not None:
+            outData = f'binary ? {outWire} : {outData}'
+        response = f"{{'data': {outData}, 'code': APIException.values.indexOf(APIException.Success)}}"
+        if cache is not None:
+            response = f'{response_cache(endpointName)}.store(cacheKey, {response})'
+        buf.write(f'    return {response};\n')
+    else:
+        buf.write(f'    {responseGetter};\n')
+        buf.write(handlerLap)
+        buf.write("    return {'code': APIException.values.indexOf(APIException.Success)};\n")
+    
+    buf.write('  } on APIException catch (e, t) {\n')
+    buf.write('    ' + log('info', "'Handled APIException:\\n$e\\n$t'"))
+    buf.write("    return {'code': APIException.values.indexOf(e)};\n")
+    buf.write('  } catch (e, t) {\n')
+    buf.write('    ' + log('error', "'Unhandled exception from API:\\n$e\\n$t'"))
+    buf.write("    return {'code': APIException.values.indexOf(APIException.InternalError)};\n")
+    buf.write('  }\n')
+    buf.write('}\n\n')
+
+def generate_request_handler(buf: StringIO):
     buf.write('Future handleRequest(HttpRequest request, APIHandler handler, AuthHandler auth) async {\n')
     # i fucking hate web programming so much. what the fuck even is CORS
     buf.write("  request.response.headers.add('Access-Control-Allow-Origin', '*');\n")
     buf.write("  request.response.headers.add('Access-Control-Allow-Methods', 'POST, OPTIONS');\n")
     buf.write("  request.response.headers.add('Access-Control-Allow-Headers', 'X-Requested-With');\n")
     buf.write("  request.response.headers.add('Access-Control-Allow-Headers', 'Content-Type');\n")
+    if metrics_config().get('route', False):
+        # a plain GET so anything that can scrape json can read it. there's no auth on this,
+        # hence it being opt-in
+        buf.write("  if (request.method == 'GET' && request.uri.path == '/_metrics') {\n")
+        buf.write('    request.response.headers.contentType = ContentType.json;\n')
+        buf.write('    request.response.write(json.encode(inMemoryMetrics.toJson()));\n')
+        buf.write('    request.response.close();\n')
+        buf.write('    return;\n')
+        buf.write('  }\n')
     buf.write("  if (request.method == 'OPTIONS') {\n")
     buf.write('    request.response.close();\n')
     buf.write('    return;\n')
-    buf.write("  } else if (request.method != 'POST') {\n")
-    buf.write('    print("Unsupported method: \'${request.method}\'");\n')
-    buf.write("    request.response.write(jsonEncode({'code': APIException.values.indexOf(APIException.UnsupportedMethod)}));\n")
+    buf.write('  }\n\n')
+    if metrics_enabled():
+        buf.write('  final sample = RequestSample(request.uri.path);\n')
+    buf.write("  if (request.method != 'POST') {\n")
+    buf.write('    ' + log('info', '"Unsupported method: \'${request.method}\'"'))
+    buf.write('    ' + respond("{'code': APIException.values.indexOf(APIException.UnsupportedMethod)}"))
+    buf.write('    return;\n')
+    buf.write('  }\n\n')
+    buf.write('  ' + log('debug', "'${request.uri}'"))
+    # an unknown endpoint is unknown whatever its body looks like, so check that before
+    # reading the body
+    routes = '_requestRoutes' if config.get('batch', False) or streamed_endpoints() else '_routes'
+    buf.write(f'  final route = {routes}[request.uri.path] ?? extraRoutes[request.uri.path];\n')
+    buf.write('  if (route == null) {\n')
+    buf.write('    ' + log('info', "'Unsupported endpoint!'"))
+    buf.write('    ' + respond("{'code': APIException.values.indexOf(APIException.UnsupportedEndpoint)}"))
+    buf.write('    return;\n')
+    buf.write('  }\n')
+    buf.write('\n')
+    # endpoints with no input don't get sent a body at all
+    buf.write('  final dynamic reqBody;\n')
+    if binary_wire():
+        # MessagePack clients say so in Content-Type if they send a body and in Accept either way -
+        # everyone else gets JSON like always
+        buf.write('  final binary = request.headers.contentType?.mimeType == MsgPack.mimeType ||\n')
+        buf.write('    (request.headers[HttpHeaders.acceptHeader]?.any((accept) => accept.contains(MsgPack.mimeType)) ?? false);\n')
+    buf.write('  try {\n')
+    if 'max_body_size' in config:
+        buf.write('    if (request.contentLength > kMaxBodySize) throw const _BodyTooLarge();\n')
+    buf.write('    Stream<List<int>> body = request;\n')
+    if metrics_enabled():
+        buf.write('    body = body.map((chunk) {\n')
+        buf.write('      sample.bytesIn += chunk.length;\n')
+        buf.write('      return chunk;\n')
+        buf.write('    });\n')
+    if 'compression' in config:
+        buf.write("    if (request.headers.value(HttpHeaders.contentEncodingHeader) == 'gzip') body = gzip.decoder.bind(body);\n")
+    if 'max_body_size' in config:
+        buf.write('    body = _limitBody(body);\n')
+    # todo: if we can tell the difference between a utf8 decode error and a json typecast error we can
+    # send back a bit more detail!
+    #
+    # the fused decoder goes straight from bytes to objects as they arrive, no intermediate String
+    jsonBody = 'request.contentLength == 0 ? null : await utf8.decoder.fuse(json.decoder).bind(body).single'
+    if binary_wire():
+        buf.write('    if (binary) {\n')
+        buf.write('      final bytes = (await body.fold<BytesBuilder>(BytesBuilder(copy: false), (bytes, chunk) => bytes..add(chunk))).takeBytes();\n')
+        buf.write('      reqBody = bytes.isEmpty ? null : MsgPack.decode(bytes);\n')
+        buf.write('    } else {\n')
+        buf.write(f'      reqBody = {jsonBody};\n')
+        buf.write('    }\n')
+    else:
+        buf.write(f'    reqBody = {jsonBody};\n')
+    decodeLap = '    sample.decodeMicros += sample.lap();\n' if metrics_enabled() else ''
+    if 'max_body_size' in config:
+        buf.write('  } on _BodyTooLarge {\n')
+        buf.write(decodeLap)
+        buf.write('    ' + log('warning', "'Request body too large'"))
+        buf.write('    request.response.statusCode = HttpStatus.requestEntityTooLarge;\n')
+        buf.write('    ' + respond("{'code': APIException.values.indexOf(APIException.ObjectFormatError)}"))
+        buf.write('    return;\n')
+    buf.write('  } catch (e, t) {\n')
+    buf.write(decodeLap)
+    buf.write('    ' + log('warning', "'Object format error:\\n$e\\n$t'"))
+    buf.write('    ' + respond("{'code': APIException.values.indexOf(APIException.ObjectFormatError)}"))
+    buf.write('    return;\n')
+    buf.write('  }\n')
+    buf.write(decodeLap.replace('    ', '  ', 1))
+    buf.write('\n')
+    buf.write(f'  final response = route({handler_args("reqBody")});\n')
+    # only go round the event loop for the endpoints that actually are async
+    if streamed_endpoints():
+        buf.write('  final res = response is Map<String, dynamic> ? response : await response;\n')
+        buf.write("  final stream = res['stream'];\n")
+        buf.write('  if (stream is Stream<dynamic>) {\n')
+        buf.write(f"    await _respondStream({'request, sample' if metrics_enabled() else 'request'}, stream);\n")
+        buf.write('    return;\n')
+        buf.write('  }\n')
+        buf.write('  ' + respond('res', binary=True))
+    else:
+        buf.write('  ' + respond('response is Map<String, dynamic> ? response : await response', binary=True))
+    buf.write('}\n\n')
+
+# one function per endpoint and a const table from path to function, so dispatch is just a map
+# lookup. extraRoutes gets checked after the generated ones, for anything registered at runtime
+def generate_routes(buf: StringIO):
+    buf.write(f'typedef RouteHandler = FutureOr<Map<String, dynamic>> Function({handler_params()});\n\n')
+    streamed = streamed_endpoints()
+    buf.write('const _routes = <String, RouteHandler>{\n')
+    for endpointName in all_endpoints():
+        if endpointName not in streamed:
+            buf.write(f"  '/{endpointName}': {handler_function(endpointName)},\n")
+    buf.write('};\n\n')
+    if config.get('batch', False) or streamed:
+        # kept out of _routes so a batch can't have batches or streams in it
+        requestRoutes = ['..._routes'] + [f"'/{endpointName}': {handler_function(endpointName)}" for endpointName in streamed]
+        if config.get('batch', False):
+            requestRoutes.append("'/_batch': _handleBatch")
+        buf.write(f"const _requestRoutes = <String, RouteHandler>{{{', '.join(requestRoutes)}}};\n\n")
+    buf.write('final extraRoutes = <String, RouteHandler>{};\n\n')
+
+# /_batch takes a list of {endpoint, data, token} and sends back a list of {code, data}, one
+# for each call, so a client can make lots of calls in one round trip
+# calls are run one after another so they see each other's side effects in order
+def generate_batch_handler(buf: StringIO):
+    buf.write(f'Future<Map<String, dynamic>> _handleBatch({handler_params()}) async {{\n')
+    buf.write('  final List<dynamic> calls;\n')
+    buf.write('  try {\n')
+    buf.write('    calls = reqBody as List<dynamic>;\n')
+    buf.write('  } catch (e, t) {\n')
+    buf.write('    ' + log('warning', "'Object format error:\\n$e\\n$t'"))
+    buf.write("    return {'code': APIException.values.indexOf(APIException.ObjectFormatError)};\n")
+    buf.write('  }\n')
+    buf.write('  final data = <Map<String, dynamic>>[];\n')
+    buf.write('  for (final call in calls) {\n')
+    buf.write(f"    final response = _handleBatched({handler_args('call')});\n")
+    buf.write('    data.add(response is Map<String, dynamic> ? response : await response);\n')
+    buf.write('  }\n')
+    buf.write("  return {'data': data, 'code': APIException.values.indexOf(APIException.Success)};\n")
+    buf.write('}\n\n')
+
+    buf.write(f"FutureOr<Map<String, dynamic>> _handleBatched({handler_params().replace('reqBody', 'call')}) {{\n")
+    buf.write('  final String endpoint;\n')
+    buf.write('  try {\n')
+    buf.write("    endpoint = call['endpoint'] as String;\n")
+    buf.write('  } catch (e, t) {\n')
+    buf.write('    ' + log('warning', "'Object format error:\\n$e\\n$t'"))
+    buf.write("    return {'code': APIException.values.indexOf(APIException.ObjectFormatError)};\n")
+    buf.write('  }\n')
+    buf.write("  final route = _routes['/$endpoint'] ?? extraRoutes['/$endpoint'];\n")
+    buf.write('  if (route == null) {\n')
+    buf.write("    return {'code': APIException.values.indexOf(APIException.UnsupportedEndpoint)};\n")
+    buf.write('  }\n')
+    buf.write(f'  return route({handler_args("call")});\n')
+    buf.write('}\n\n')
+
+# the response maps an endpoint hands back are what get cached - _cachedResponses links
+# each one to its entry so _respond can tell it's seen it before and reuse the bytes. the ETag
+# is a hash of those bytes, so isolates that cached the same thing hand out the same tag
+def generate_response_cache(buf: StringIO):
+    buf.write('class _CachedResponse {\n')
+    buf.write('  final Map<String, dynamic> response;\n')
+    buf.write('  final int expires;\n')
+    buf.write('  List<int>? bytes;\n')
+    buf.write('  String? etag;\n')
+    if 'compression' in config:
+        buf.write('  List<int>? gzipped;\n')
+    buf.write('\n')
+    buf.write('  _CachedResponse(this.response, this.expires);\n')
+    buf.write('}\n\n')
+
+    buf.write('final _cacheClock = Stopwatch()..start();\n')
+    buf.write('final _cachedResponses = Expando<_CachedResponse>();\n\n')
+
+    buf.write('class _ResponseCache {\n')
+    buf.write('  final Duration ttl;\n')
+    buf.write('  final int size;\n')
+    buf.write('  final _entries = <String, _CachedResponse>{};\n\n')
+    buf.write('  _ResponseCache(this.ttl, this.size);\n\n')
+    buf.write('  Map<String, dynamic>? lookup(String key) {\n')
+    buf.write('    final cached = _entries[key];\n')
+    buf.write('    if (cached == null) return null;\n')
+    buf.write('    if (cached.expires > _cacheClock.elapsedMilliseconds) return cached.response;\n')
+    buf.write('    _entries.remove(key);\n')
+    buf.write('    return null;\n')
+    buf.write('  }\n\n')
+    buf.write('  Map<String, dynamic> store(String key, Map<String, dynamic> response) {\n')
+    buf.write('    if (_entries.length >= size) _entries.remove(_entries.keys.first);\n')
+    buf.write('    final cached = _entries[key] = _CachedResponse(response, _cacheClock.elapsedMilliseconds + ttl.inMilliseconds);\n')
+    buf.write('    _cachedResponses[response] = cached;\n')
+    buf.write('    return response;\n')
+    buf.write('  }\n\n')
+    buf.write('  void clear() => _entries.clear();\n')
+    buf.write('}\n\n')
+
+    for endpointName, cache in cached_endpoints().items():
+        buf.write(f'final {response_cache(endpointName)} = _ResponseCache(const Duration(seconds: {cache.get("ttl", 60)}), {cache.get("size", 256)});\n')
+    buf.write('\n')
+    # for handlers to call when they've changed something a cached endpoint would return
+    buf.write('void clearResponseCaches() {\n')
+    for endpointName in cached_endpoints():
+        buf.write(f'  {response_cache(endpointName)}.clear();\n')
+    buf.write('}\n\n')
+
+    buf.write('String _etag(List<int> bytes) {\n')
+    buf.write('  var hash = 0x811c9dc5;\n')
+    buf.write('  for (final byte in bytes) {\n')
+    buf.write('    hash = ((hash ^ byte) * 0x01000193) & 0xffffffff;\n')
+    buf.write('  }\n')
+    buf.write("  return '\"${hash.toRadixString(16)}-${bytes.length}\"';\n")
+    buf.write('}\n\n')
+
+    params = 'HttpRequest request, _CachedResponse cached'
+    if binary_wire():
+        params += ', bool binary'
+    if metrics_enabled():
+        params += ', RequestSample sample'
+    buf.write(f'void _respondCached({params}) {{\n')
+    if binary_wire():
+        buf.write('  final bytes = cached.bytes ??= binary ? MsgPack.encode(cached.response) : const JsonUtf8Encoder().convert(cached.response);\n')
+    else:
+        buf.write('  final bytes = cached.bytes ??= const JsonUtf8Encoder().convert(cached.response);\n')
+    buf.write('  final etag = cached.etag ??= _etag(bytes);\n')
+    buf.write('  request.response.headers.set(HttpHeaders.etagHeader, etag);\n')
+    # everything's a POST so this is our own convention rather than plain HTTP caching - only
+    # the generated frontend is expected to send If-None-Match
+    buf.write('  if (request.headers[HttpHeaders.ifNoneMatchHeader]?.any((match) => match.contains(etag)) ?? false) {\n')
+    buf.write('    request.response.statusCode = HttpStatus.notModified;\n')
     buf.write('    request.response.close();\n')
     buf.write('    return;\n')
+    buf.write('  }\n')
+    if 'compression' in config:
+        buf.write('  if (bytes.length >= kGzipThreshold && _acceptsGzip(request)) {\n')
+        buf.write("    request.response.headers.set(HttpHeaders.contentEncodingHeader, 'gzip');\n")
+        buf.write('    final gzipped = cached.gzipped ??= gzip.encode(bytes);\n')
+        if metrics_enabled():
+            buf.write('    sample.bytesOut = gzipped.length;\n')
+        buf.write('    request.response.add(gzipped);\n')
+        buf.write('  } else {\n')
+        if metrics_enabled():
+            buf.write('    sample.bytesOut = bytes.length;\n')
+        buf.write('    request.response.add(bytes);\n')
+        buf.write('  }\n')
+    else:
+        if metrics_enabled():
+            buf.write('  sample.bytesOut = bytes.length;\n')
+        buf.write('  request.response.add(bytes);\n')
+    buf.write('  request.response.close();\n')
+    buf.write('}\n\n')
+
+# validateToken results get kept for ttl seconds, up to size tokens. the map keeps insertion
+# order, so moving a token to the back whenever it's used leaves the least recently used one
+# at the front for eviction. each isolate gets its own cache, so a token revoked in one isolate
+# can live on in the others for up to ttl
+def generate_token_cache(buf: StringIO):
+    cacheConfig = auth_config().get('cache') or {}
+    tokenType = config['auth']['out']
+    isAsync = auth_async()
+    if resolve_type(tokenType).kind in [PRIMITIVE, ENUM]:
+        keyType, key = tokenType, 'token'
+    else:
+        keyType, key = 'String', f'json.encode({toJson(tokenType, "token")})'
+
+    buf.write(f'const kTokenCacheTtl = Duration(seconds: {cacheConfig.get("ttl", 60)});\n')
+    buf.write(f'const kTokenCacheSize = {cacheConfig.get("size", 1024)};\n\n')
+
+    buf.write('class _CachedAuth {\n')
+    buf.write('  final AuthLevel level;\n')
+    buf.write('  final int expires;\n\n')
+    buf.write('  const _CachedAuth(this.level, this.expires);\n')
+    buf.write('}\n\n')
+
+    buf.write('final _authClock = Stopwatch()..start();\n')
+    buf.write(f'final _tokenCache = <{keyType}, _CachedAuth>{{}};\n\n')
+
+    buf.write(f'{"Future<AuthLevel>" if isAsync else "AuthLevel"} _validateToken(AuthHandler auth, {tokenType} token) {"async " if isAsync else ""}{{\n')
+    buf.write(f'  final key = {key};\n')
+    buf.write('  final cached = _tokenCache.remove(key);\n')
+    buf.write('  if (cached != null && cached.expires > _authClock.elapsedMilliseconds) {\n')
+    buf.write('    _tokenCache[key] = cached;\n')
+    buf.write('    return cached.level;\n')
     buf.write('  }\n\n')
-    buf.write("  print('${request.uri}');\n")
-    buf.write('  switch (request.uri.toString()) {\n')
-    for endpointName, endpointType in config_dict('endpoints').items():
-        buf.write(f'    // {endpointType}\n')
-        buf.write(f"    case '/{endpointName}': {{\n")
-        if 'in' in endpointType or 'authLevel' in endpointType or endpointType.get('forwardToken', False):
-            if 'in' in endpointType:
-                buf.write(f'      final {endpointType.get("in", "void")} reqData;\n')
-            if 'authLevel' in endpointType or endpointType.get('forwardToken', False):
-                buf.write(f'      final {config["auth"]["out"]} token;\n')
-            buf.write('      try {\n')
-            # todo: if we can tell the difference between a utf8 decode error and a json typecast error we can
-            # send back a bit more detail!
-            buf.write(f'        final reqBody = jsonDecode(await utf8.decoder.bind(request).join());\n')
-            if 'in' in endpointType:
-                reqDataGetter = fromJson(endpointType['in'], "reqBody['data']")
-                buf.write(f"        reqData = {reqDataGetter};\n")
-            if 'authLevel' in endpointType or endpointType.get('forwardToken', False):
-                buf.write(f"        token = reqBody['token'];\n")
-            buf.write('      } catch (e, t) {\n')
-            buf.write("        print('Object format error:\\n$e\\n$t');\n")
-            buf.write("        request.response.write(jsonEncode({'code': APIException.values.indexOf(APIException.ObjectFormatError)}));\n")
-            buf.write('        request.response.close();\n')
-            buf.write('        return;\n')
-            buf.write('      }\n\n')
-        buf.write('      Map<String, dynamic> response;\n')
-        buf.write('      try {\n')
-
-        if 'authLevel' in endpointType:
-            if endpointType['authLevel'] == 'Custom':
-                buf.write(f'        if (!auth.{endpointName}Auth(token')
-                if 'in' in endpointType:
-                    buf.write(', reqData')
-                buf.write(')) {\n')
-            else:
-                buf.write('        final tokenLevel = auth.validateToken(token);\n')
-                buf.write(f'        if (AuthLevel.values.indexOf(tokenLevel) < AuthLevel.values.indexOf(AuthLevel.{endpointType["authLevel"]})) {{\n')
-            buf.write("          request.response.write(jsonEncode({'code': APIException.values.indexOf(APIException.Unauthorized)}));\n")
-            buf.write('          request.response.close();\n')
-            buf.write('          return;\n')
-            buf.write('        }\n\n')
+    buf.write(f'  final level = {await_if(isAsync)}auth.validateToken(token);\n')
+    buf.write('  _tokenCache[key] = _CachedAuth(level, _authClock.elapsedMilliseconds + kTokenCacheTtl.inMilliseconds);\n')
+    buf.write('  if (_tokenCache.length > kTokenCacheSize) _tokenCache.remove(_tokenCache.keys.first);\n')
+    buf.write('  return level;\n')
+    buf.write('}\n\n')
 
-        if 'out' in endpointType:
-            buf.write("        response = {'data': ")
-        
-        if endpointName == '_authorize':
-            responseGetter = f'auth.generateToken('
-        elif endpointType.get('handledBy', 'main') == 'main':
-            responseGetter = f'handler.{endpointName}('
-        elif endpointType.get('handledBy', 'main') == 'auth':
-            responseGetter = f'auth.{endpointName}('
-        else:
-            raise ValueError(f"Unknown request handler '{endpointType.get('handledBy', 'main')}'!")
+    buf.write('// for when a token gets revoked somewhere other than an invalidatesToken endpoint\n')
+    buf.write(f'void invalidateToken({tokenType} token) => _tokenCache.remove({key});\n')
+    buf.write('void clearTokenCache() => _tokenCache.clear();\n\n')
 
-        if 'out' not in endpointType:
-            responseGetter = '        ' + responseGetter
-        
-        if endpointType.get('forwardToken', False):
-            responseGetter += 'token'
-            if 'in' in endpointType:
-                responseGetter += ', '
+# awaiting handleRequest for each request in turn means one slow handler holds up everyone,
+# so serve() lets up to maxInFlight run at once. each isolate builds its own handlers once up
+# front - they don't share memory, so handlers that keep state in themselves (rather than a
+# database or whatever) should stick to one isolate. a crash in any isolate gets logged, and
+# once serve() itself stops (a failed bind, say) it takes the isolates it spawned down with
+# it, so a caller that retries doesn't pile a fresh set on top of the old ones
+def generate_serve(buf: StringIO):
+    serveConfig = config_dict('serve')
+    buf.write(f'const kMaxInFlight = {serveConfig.get("max_in_flight", 64)};\n')
+    buf.write(f'const kServeIsolates = {serveConfig.get("isolates", 1)};\n\n')
 
-        if 'in' in endpointType:
-            responseGetter += 'reqData'
-        
-        responseGetter += ')'
+    buf.write('class _ServeOptions {\n')
+    buf.write('  final APIHandler Function() handlerFactory;\n')
+    buf.write('  final AuthHandler Function() authFactory;\n')
+    buf.write('  final Object address;\n')
+    buf.write('  final int port;\n')
+    buf.write('  final SecurityContext Function()? securityContext;\n')
+    buf.write('  final int maxInFlight;\n')
+    buf.write('  final bool shared;\n\n')
+    buf.write('  _ServeOptions(this.handlerFactory, this.authFactory, this.address, this.port, this.securityContext, this.maxInFlight, this.shared);\n')
+    buf.write('}\n\n')
 
-        if 'out' in endpointType:
-            buf.write(toJson(endpointType['out'], responseGetter))
-            buf.write(", 'code': APIException.values.indexOf(APIException.Success)}")
-        else:
-            buf.write(responseGetter)
-        
-        buf.write(';\n')
-        
-        if 'out' not in endpointType:
-            buf.write("        response = {'code': APIException.values.indexOf(APIException.Success)};\n")
-        
-        buf.write('      } on APIException catch (e, t) {\n')
-        buf.write("        print('Handled APIException:\\n$e\\n$t');\n")
-        buf.write("        response = {'code': APIException.values.indexOf(e)};\n")
-        buf.write('      } catch (e, t) {\n')
-        buf.write("        print('Unhandled exception from API:\\n$e\\n$t');\n")
-        buf.write("        response = {'code': APIException.values.indexOf(APIException.InternalError)};\n")
-        buf.write('      }\n')
-        buf.write('      request.response.write(jsonEncode(response));\n')
-        buf.write('      request.response.close();\n')
-        buf.write('      break;\n')
-        buf.write('    }\n')
-    
-    buf.write("    default: {\n")
-    buf.write("      print('Unsupported endpoint!');\n")
-    buf.write("      request.response.write(jsonEncode({'code': APIException.values.indexOf(APIException.UnsupportedEndpoint)}));\n")
-    buf.write('      request.response.close();\n')
-    buf.write('    }\n  }\n}\n')
-    
+    buf.write('Future<void> serve(APIHandler Function() handlerFactory, AuthHandler Function() authFactory, {\n')
+    buf.write('  Object? address,\n')
+    buf.write('  int port = kApiUseHttps ? 443 : 8080,\n')
+    buf.write('  SecurityContext Function()? securityContext,\n')
+    buf.write('  int maxInFlight = kMaxInFlight,\n')
+    buf.write('  int isolates = kServeIsolates\n')
+    buf.write('}) async {\n')
+    buf.write('  final options = _ServeOptions(handlerFactory, authFactory, address ?? InternetAddress.anyIPv4, port, securityContext, maxInFlight, isolates > 1);\n')
+    buf.write('  final errors = ReceivePort();\n')
+    buf.write('  errors.listen((error) {\n')
+    # errors come through as [error, stack trace], both already strings
+    buf.write('    final details = error as List<dynamic>;\n')
+    buf.write('    ' + log('error', "'Serving isolate crashed:\\n${details[0]}\\n${details[1]}'"))
+    buf.write('  });\n')
+    buf.write('  final spawned = <Isolate>[];\n')
+    buf.write('  try {\n')
+    buf.write('    for (var i = 1; i < isolates; i++) {\n')
+    buf.write('      spawned.add(await Isolate.spawn(_serveIsolate, options, onError: errors.sendPort));\n')
+    buf.write('    }\n')
+    buf.write('    await _serveIsolate(options);\n')
+    buf.write('  } finally {\n')
+    buf.write('    for (final isolate in spawned) {\n')
+    buf.write('      isolate.kill(priority: Isolate.immediate);\n')
+    buf.write('    }\n')
+    buf.write('    errors.close();\n')
+    buf.write('  }\n')
+    buf.write('}\n\n')
 
-def generate_frontend(buf: StringIO):
+    buf.write('Future<void> _serveIsolate(_ServeOptions options) async {\n')
+    buf.write('  final handler = options.handlerFactory();\n')
+    buf.write('  final auth = options.authFactory();\n')
+    buf.write('  final server = options.securityContext == null\n')
+    buf.write('    ? await HttpServer.bind(options.address, options.port, shared: options.shared)\n')
+    buf.write('    : await HttpServer.bindSecure(options.address, options.port, options.securityContext!(), shared: options.shared);\n\n')
+    buf.write('  var inFlight = 0;\n')
+    buf.write('  Completer<void>? slotFree;\n')
+    # waiting here pauses the server stream, so we stop accepting until something finishes
+    buf.write('  await for (final request in server) {\n')
+    buf.write('    while (inFlight >= options.maxInFlight) {\n')
+    buf.write('      await (slotFree ??= Completer<void>()).future;\n')
+    buf.write('    }\n')
+    buf.write('    inFlight++;\n')
+    buf.write('    handleRequest(request, handler, auth).catchError((e, t) {\n')
+    buf.write('      ' + log('error', "'Unhandled exception while handling request:\\n$e\\n$t'"))
+    buf.write('    }).whenComplete(() {\n')
+    buf.write('      inFlight--;\n')
+    buf.write('      final waiting = slotFree;\n')
+    buf.write('      slotFree = null;\n')
+    buf.write('      waiting?.complete();\n')
+    buf.write('    });\n')
+    buf.write('  }\n')
+    buf.write('}\n\n')
+
+def generate_server(buf: Chunk):
+    section(buf, 'server logging', None, generate_logger)
+    if metrics_enabled():
+        section(buf, 'server metrics', [list(all_endpoints()), config.get('batch', False)], generate_metrics)
+    section(buf, 'server handlers', config_dict('endpoints'), generate_handler_interfaces)
+
+    section(buf, 'server request helpers', [bool(cached_endpoints()), bool(streamed_endpoints())], generate_request_helpers)
+    if token_cache_enabled():
+        section(buf, 'server token cache', None, generate_token_cache)
+    if cached_endpoints():
+        section(buf, 'server response cache', cached_endpoints(), generate_response_cache)
+    for endpointName, endpointType in all_endpoints().items():
+        section(buf, f'server endpoint {endpointName}', endpointType, lambda buf: generate_request_endpoint(buf, endpointName, endpointType))
+    section(buf, 'server routes', [list(all_endpoints()), streamed_endpoints(), config.get('batch', False)], generate_routes)
+    section(buf, 'server request handler', bool(streamed_endpoints()), generate_request_handler)
+    if config.get('batch', False):
+        section(buf, 'server batch', None, generate_batch_handler)
+    section(buf, 'server serve', None, generate_serve)
+
+def generate_frontend_head(buf: StringIO):
     buf.write('class API {\n')
     buf.write('  static void Function(APIException)? onError;\n\n')
 
@@ -422,75 +1943,890 @@ def generate_frontend(buf: StringIO):
     buf.write('  }\n\n')
 
     if 'auth' in config:
-        config['endpoints']['_authorize'] = config['auth']
         buf.write(f'  static {config["auth"]["out"]}? _token;\n')
         buf.write(f'  static Future<void> authorize({config["auth"]["in"]} credentials) async => _token = await _authorize(credentials);\n')
         buf.write('  static void clearToken() => _token = null;\n\n')
 
-    for endpointName, endpointDetails in config_dict('endpoints').items():
-        buf.write(f'  static Future<{endpointDetails.get("out", "void")}> {endpointName}(')
+    # one keep-alive client (or one per endpoint if you'd rather they didn't share a pool)
+    # instead of package:http's top-level functions, which open a new connection every call
+    clientConfig = config_dict('client')
+    buf.write('  static Client Function() clientFactory = () => IOClient(HttpClient()\n')
+    buf.write(f'    ..maxConnectionsPerHost = {clientConfig.get("max_connections", 6)}\n')
+    # HttpClient already asks for gzip and unzips it for us, this just makes sure nobody turns it off
+    if 'compression' in config:
+        buf.write('    ..autoUncompress = true\n')
+    buf.write(f'    ..idleTimeout = const Duration(seconds: {clientConfig.get("idle_timeout", 15)}));\n\n')
+    # for calls that don't pass a timeout of their own
+    if 'timeout' in clientConfig:
+        buf.write(f'  static Duration? defaultTimeout = const Duration(seconds: {clientConfig["timeout"]});\n\n')
+    else:
+        buf.write('  static Duration? defaultTimeout;\n\n')
+    if clientConfig.get('shared', True):
+        buf.write('  static Client? _client;\n')
+        buf.write('  static Client get client => _client ??= clientFactory();\n')
+        buf.write('  static set client(Client client) => _client = client;\n\n')
+        buf.write('  static void dispose() {\n')
+        buf.write('    _client?.close();\n')
+        buf.write('    _client = null;\n')
+        buf.write('  }\n\n')
+    else:
+        buf.write('  static final _clients = <String, Client>{};\n')
+        buf.write('  static Client _clientFor(String endpoint) => _clients[endpoint] ??= clientFactory();\n\n')
+        buf.write('  static void dispose() {\n')
+        buf.write('    for (final client in _clients.values) { client.close(); }\n')
+        buf.write('    _clients.clear();\n')
+        buf.write('  }\n\n')
+
+# dedupe: true in the client section (or on a single endpoint) makes identical calls that are
+# in flight at the same time share one request. it's opt in since two identical calls to
+# something that isn't idempotent might well both be meant
+def endpoint_dedupe(endpointName: str, endpointType: dict[str, Any]) -> bool:
+    return endpointType.get('dedupe', config_dict('client').get('dedupe', False)) and not endpoint_stream(endpointName, endpointType)
+
+def deduped_endpoints() -> list[str]:
+    return [endpointName for endpointName, endpointType in all_endpoints().items() if endpoint_dedupe(endpointName, endpointType)]
+
+def post_params() -> str:
+    params = []
+    if cached_endpoints():
+        params.append('Duration? cacheFor')
+    if deduped_endpoints():
+        params.append('bool dedupe = false')
+    return ', '.join(params + ['CancelToken? cancel', 'Duration? timeout'])
+
+def post_args() -> str:
+    args = []
+    if cached_endpoints():
+        args.append('cacheFor: cacheFor')
+    if deduped_endpoints():
+        args.append('dedupe: dedupe')
+    return ', '.join(args + ['cancel: cancel', 'timeout: timeout'])
+
+def client_getter(endpoint: str) -> str:
+    if config_dict('client').get('shared', True):
+        return 'client'
+    return f'_clientFor({endpoint})'
+
+def generate_frontend_transport(buf: StringIO):
+    caching = bool(cached_endpoints())
+    deduping = bool(deduped_endpoints())
+    if caching:
+        # keyed on the encoded request, token and all. fresh entries don't touch the network at
+        # all, stale ones get sent back to the server to check if they're still good
+        buf.write('  static int responseCacheSize = 256;\n')
+        buf.write('  static final _responseCache = <String, _ResponseCacheEntry>{};\n')
+        buf.write('  static void clearResponseCache() => _responseCache.clear();\n\n')
+    if deduping:
+        buf.write('  static final _inFlight = <String, _InFlight>{};\n\n')
+
+    buf.write(f'  static Future<Map<String, dynamic>> _post(String endpoint, Object? body, {{{post_params()}}}) async {{\n')
+    buf.write('    final List<int>? bytes;\n')
+    buf.write('    try {\n')
+    if binary_wire():
+        buf.write('      bytes = body == null ? null : MsgPack.encode(body);\n')
+    else:
+        buf.write('      bytes = body == null ? null : const JsonUtf8Encoder().convert(body);\n')
+    buf.write('    } catch (e) {\n')
+    buf.write('      _error(APIException.InternalError);\n')
+    buf.write('    }\n')
+    if caching or deduping:
+        # same bytes means same request, token and all
+        keyed = ' && '.join((['cacheFor == null'] if caching else []) + (['!dedupe'] if deduping else []))
+        buf.write(f"    final key = {keyed} ? null : '$endpoint ${{bytes == null ? '' : String.fromCharCodes(bytes)}}';\n")
+    if caching:
+        buf.write('    final cached = cacheFor == null ? null : _responseCache[key!];\n')
+        buf.write('    if (cached != null && cached.expires.isAfter(DateTime.now())) return cached.response;\n')
+    requestArgs = 'endpoint, bytes, {}.released.future, key, cached, cacheFor' if caching else 'endpoint, bytes, {}.released.future'
+    if deduping:
+        buf.write('    var call = dedupe ? _inFlight[key!] : null;\n')
+        buf.write('    if (call == null) {\n')
+        # an entry only finishes once, and a new one for the same key can't start until it has,
+        # so whatever's under the key when it finishes is this one
+        buf.write('      final started = call = dedupe ? _InFlight(() => _inFlight.remove(key)) : _InFlight();\n')
+        buf.write('      if (dedupe) _inFlight[key!] = started;\n')
+        buf.write(f'      started.start(_request({requestArgs.format("started")}));\n')
+        buf.write('    }\n')
+    else:
+        buf.write('    final call = _InFlight();\n')
+        buf.write(f'    call.start(_request({requestArgs.format("call")}));\n')
+    buf.write('    return call.wait(cancel, timeout);\n')
+    buf.write('  }\n\n')
+
+    if caching:
+        buf.write('  static Future<Map<String, dynamic>> _request(String endpoint, List<int>? bytes, Future<void> released, String? key, _ResponseCacheEntry? cached, Duration? cacheFor) async {\n')
+    else:
+        buf.write('  static Future<Map<String, dynamic>> _request(String endpoint, List<int>? bytes, Future<void> released) async {\n')
+    buf.write('    try {\n')
+    if 'compression' in config:
+        buf.write('      final compress = bytes != null && bytes.length >= kGzipThreshold;\n')
+    scheme = 'https' if USE_HTTPS else 'http'
+    buf.write(f"      final request = Request('POST', Uri.{scheme}('{API_URL}', '/$endpoint'));\n")
+    if 'compression' in config:
+        buf.write('      if (bytes != null) request.bodyBytes = compress ? gzip.encode(bytes) : bytes;\n')
+    else:
+        buf.write('      if (bytes != null) request.bodyBytes = bytes;\n')
+    buf.write('      request.headers.addAll({\n')
+    if binary_wire():
+        buf.write('        HttpHeaders.acceptHeader: MsgPack.mimeType,\n')
+        buf.write('        if (bytes != null) HttpHeaders.contentTypeHeader: MsgPack.mimeType,\n')
+    else:
+        buf.write("        if (bytes != null) HttpHeaders.contentTypeHeader: 'application/json',\n")
+    if 'compression' in config:
+        buf.write("        if (compress) HttpHeaders.contentEncodingHeader: 'gzip',\n")
+    if caching:
+        buf.write('        if (cached != null) HttpHeaders.ifNoneMatchHeader: cached.etag,\n')
+    buf.write('      });\n')
+    buf.write(f"      final response = await _fetch({client_getter('endpoint')}, request, released);\n")
+    if caching:
+        buf.write('      if (cached != null && response.statusCode == HttpStatus.notModified) {\n')
+        buf.write('        cached.expires = DateTime.now().add(cacheFor!);\n')
+        buf.write('        return cached.response;\n')
+        buf.write('      }\n\n')
+        if binary_wire():
+            buf.write('      final Map<String, dynamic> res;\n')
+            buf.write('      if (response.headers[HttpHeaders.contentTypeHeader]?.startsWith(MsgPack.mimeType) ?? false) {\n')
+            buf.write('        res = MsgPack.decode(response.bodyBytes);\n')
+            buf.write('      } else {\n')
+            buf.write('        res = utf8.decoder.fuse(json.decoder).convert(response.bodyBytes) as Map<String, dynamic>;\n')
+            buf.write('      }\n')
+        else:
+            buf.write('      final res = utf8.decoder.fuse(json.decoder).convert(response.bodyBytes) as Map<String, dynamic>;\n')
+        buf.write('      final etag = response.headers[HttpHeaders.etagHeader];\n')
+        buf.write('      if (cacheFor != null && etag != null) {\n')
+        buf.write('        if (_responseCache.remove(key) == null && _responseCache.length >= responseCacheSize) _responseCache.remove(_responseCache.keys.first);\n')
+        buf.write('        _responseCache[key!] = _ResponseCacheEntry(res, etag, DateTime.now().add(cacheFor));\n')
+        buf.write('      }\n')
+        buf.write('      return res;\n')
+    else:
+        if binary_wire():
+            # errors from before the server's worked out what we want still come back as JSON
+            buf.write('      if (response.headers[HttpHeaders.contentTypeHeader]?.startsWith(MsgPack.mimeType) ?? false) {\n')
+            buf.write('        return MsgPack.decode(response.bodyBytes);\n')
+            buf.write('      }\n')
+        buf.write('      return utf8.decoder.fuse(json.decoder).convert(response.bodyBytes) as Map<String, dynamic>;\n')
+    buf.write('    } on RequestCancelled {\n')
+    buf.write('      rethrow;\n')
+    buf.write('    } catch (e) {\n')
+    buf.write('      _error(APIException.InternalError);\n')
+    buf.write('    }\n')
+    buf.write('  }\n\n')
+
+    # package:http has no way to abort a request, so the closest we can get once nobody wants
+    # the response is to drop the connection as soon as there's one to drop, without reading
+    # or decoding any more of it
+    buf.write('  static Future<Response> _fetch(Client client, BaseRequest request, Future<void> released) {\n')
+    buf.write('    final out = Completer<Response>();\n')
+    buf.write('    released.then((_) {\n')
+    buf.write('      if (!out.isCompleted) out.completeError(const RequestCancelled());\n')
+    buf.write('    });\n')
+    buf.write('    client.send(request).then((response) {\n')
+    buf.write('      if (out.isCompleted) {\n')
+    buf.write('        response.stream.listen(null).cancel();\n')
+    buf.write('        return;\n')
+    buf.write('      }\n')
+    buf.write('      final body = BytesBuilder(copy: false);\n')
+    buf.write('      final subscription = response.stream.listen(body.add, cancelOnError: true, onError: (Object e, StackTrace t) {\n')
+    buf.write('        if (!out.isCompleted) out.completeError(e, t);\n')
+    buf.write('      }, onDone: () {\n')
+    buf.write('        if (!out.isCompleted) out.complete(Response.bytes(body.takeBytes(), response.statusCode, request: request, headers: response.headers));\n')
+    buf.write('      });\n')
+    buf.write('      released.then((_) => subscription.cancel());\n')
+    buf.write('    }, onError: (Object e, StackTrace t) {\n')
+    buf.write('      if (!out.isCompleted) out.completeError(e, t);\n')
+    buf.write('    });\n')
+    buf.write('    return out.future;\n')
+    buf.write('  }\n\n')
+
+    buf.write('  static Map<String, dynamic> _check(Map<String, dynamic> res) {\n')
+    buf.write('    final int code;\n')
+    buf.write('    try {\n')
+    buf.write("      code = res['code'] as int;\n")
+    buf.write('    } catch (e) {\n')
+    buf.write('      _error(APIException.InternalError);\n')
+    buf.write('    }\n\n')
+    buf.write('    if (APIException.values[code] != APIException.Success) { _error(APIException.values[code]); }\n')
+    buf.write('    return res;\n')
+    buf.write('  }\n\n')
+
+    if streamed_endpoints():
+        generate_frontend_stream(buf)
+
+    if not config.get('batch', False):
+        buf.write(f'  static Future<Map<String, dynamic>> _send(String endpoint, Map<String, dynamic>? body, {{{post_params()}}}) async => _check(await _post(endpoint, body, {post_args()}));\n\n')
+        return
+
+    # calls made inside API.batch(), or in the same microtask when coalesce is on, get queued
+    # up and sent to /_batch together
+    buf.write('  static bool coalesce = false;\n')
+    buf.write('  static List<_BatchedCall>? _batch;\n')
+    buf.write('  static List<_BatchedCall>? _coalesced;\n\n')
+
+    buf.write('  static Future<T> batch<T>(Future<T> Function() calls) {\n')
+    buf.write('    final outer = _batch;\n')
+    buf.write('    final batched = _batch = <_BatchedCall>[];\n')
+    buf.write('    final Future<T> out;\n')
+    buf.write('    try {\n')
+    buf.write('      out = calls();\n')
+    buf.write('    } finally {\n')
+    buf.write('      _batch = outer;\n')
+    buf.write('    }\n')
+    buf.write('    _flush(batched);\n')
+    buf.write('    return out;\n')
+    buf.write('  }\n\n')
+
+    buf.write(f'  static Future<Map<String, dynamic>> _send(String endpoint, Map<String, dynamic>? body, {{{post_params()}}}) async {{\n')
+    if caching:
+        # batched responses don't come with ETags, so cached endpoints always go on their own
+        buf.write(f'    if (cacheFor != null) return _check(await _post(endpoint, body, {post_args()}));\n')
+    buf.write('    var queue = _batch;\n')
+    buf.write('    if (queue == null && coalesce) {\n')
+    buf.write('      queue = _coalesced;\n')
+    buf.write('      if (queue == null) {\n')
+    buf.write('        queue = _coalesced = [];\n')
+    buf.write('        scheduleMicrotask(() {\n')
+    buf.write('          final calls = _coalesced!;\n')
+    buf.write('          _coalesced = null;\n')
+    buf.write('          _flush(calls);\n')
+    buf.write('        });\n')
+    buf.write('      }\n')
+    buf.write('    }\n')
+    buf.write(f'    if (queue == null) return _check(await _post(endpoint, body, {post_args()}));\n\n')
+    buf.write('    final call = _BatchedCall(endpoint, body);\n')
+    buf.write('    queue.add(call);\n')
+    # the rest of the batch still wants its answers, so all giving up does here is stop waiting
+    buf.write('    Future<Map<String, dynamic>> out = call.completer.future;\n')
+    buf.write("    if (cancel != null) out = Future.any([out, cancel.whenCancelled.then((_) => throw const RequestCancelled())]);\n")
+    buf.write('    timeout ??= defaultTimeout;\n')
+    buf.write('    return timeout == null ? out : out.timeout(timeout);\n')
+    buf.write('  }\n\n')
+
+    buf.write('  static Future<void> _flush(List<_BatchedCall> calls) async {\n')
+    buf.write('    if (calls.isEmpty) return;\n')
+    buf.write('    if (calls.length == 1) {\n')
+    buf.write('      final call = calls.single;\n')
+    buf.write('      try {\n')
+    buf.write('        call.completer.complete(_check(await _post(call.endpoint, call.body)));\n')
+    buf.write('      } catch (e) {\n')
+    buf.write('        call.completer.completeError(e);\n')
+    buf.write('      }\n')
+    buf.write('      return;\n')
+    buf.write('    }\n\n')
+    buf.write('    final List<dynamic> results;\n')
+    buf.write('    try {\n')
+    buf.write("      results = _check(await _post('_batch', [for (final call in calls) {'endpoint': call.endpoint, ...?call.body}]))['data'] as List<dynamic>;\n")
+    buf.write('    } catch (e) {\n')
+    buf.write('      for (final call in calls) { call.completer.completeError(e); }\n')
+    buf.write('      return;\n')
+    buf.write('    }\n\n')
+    buf.write('    for (final (i, call) in calls.indexed) {\n')
+    buf.write('      try {\n')
+    buf.write('        call.completer.complete(_check(results[i] as Map<String, dynamic>));\n')
+    buf.write('      } catch (e) {\n')
+    buf.write('        call.completer.completeError(e);\n')
+    buf.write('      }\n')
+    buf.write('    }\n')
+    buf.write('  }\n\n')
+
+# items come out as soon as their line has arrived, and cancelling the subscription drops the
+# connection. streams never get batched or cached
+def generate_frontend_stream(buf: StringIO):
+    scheme = 'https' if USE_HTTPS else 'http'
+    buf.write('  static Stream<dynamic> _stream(String endpoint, Map<String, dynamic>? body) async* {\n')
+    buf.write(f"    final request = Request('POST', Uri.{scheme}('{API_URL}', '/$endpoint'));\n")
+    buf.write('    if (body != null) {\n')
+    buf.write("      request.headers[HttpHeaders.contentTypeHeader] = 'application/json';\n")
+    buf.write('      request.bodyBytes = const JsonUtf8Encoder().convert(body);\n')
+    buf.write('    }\n')
+    buf.write('    final StreamedResponse response;\n')
+    buf.write('    try {\n')
+    buf.write(f"      response = await {client_getter('endpoint')}.send(request);\n")
+    buf.write('    } catch (e) {\n')
+    buf.write('      _error(APIException.InternalError);\n')
+    buf.write('    }\n\n')
+    # errors from before the stream got going are just the usual single {'code': ...}, which
+    # reads the same as the last line of a stream
+    buf.write('    Map<String, dynamic>? trailer;\n')
+    buf.write('    try {\n')
+    buf.write('      await for (final line in response.stream.transform(utf8.decoder).transform(const LineSplitter())) {\n')
+    buf.write('        if (line.isEmpty) continue;\n')
+    buf.write('        final res = json.decode(line) as Map<String, dynamic>;\n')
+    buf.write("        if (res.containsKey('code')) {\n")
+    buf.write('          trailer = res;\n')
+    buf.write('          break;\n')
+    buf.write('        }\n')
+    buf.write("        yield res['data'];\n")
+    buf.write('      }\n')
+    buf.write('    } catch (e) {\n')
+    buf.write('      _error(APIException.InternalError);\n')
+    buf.write('    }\n')
+    # a connection that drops before the end doesn't have one, which _check counts as an error
+    buf.write('    _check(trailer ?? const {});\n')
+    buf.write('  }\n\n')
+
+def generate_batched_call(buf: StringIO):
+    buf.write('\nclass _BatchedCall {\n')
+    buf.write('  final String endpoint;\n')
+    buf.write('  final Map<String, dynamic>? body;\n')
+    buf.write('  final completer = Completer<Map<String, dynamic>>();\n\n')
+    buf.write('  _BatchedCall(this.endpoint, this.body);\n')
+    buf.write('}\n')
+
+# callers that give up on a call (cancelled, or out of time) get a RequestCancelled or a
+# TimeoutException. once every caller sharing a request has given up, it's dropped. onDone
+# runs as soon as the response is in or the request's been dropped, synchronously, so no
+# caller can join a call that's already over in the meantime
+def generate_cancellation(buf: StringIO):
+    buf.write('\nclass CancelToken {\n')
+    buf.write('  final _cancelled = Completer<void>();\n\n')
+    buf.write('  bool get isCancelled => _cancelled.isCompleted;\n')
+    buf.write('  Future<void> get whenCancelled => _cancelled.future;\n\n')
+    buf.write('  void cancel() {\n')
+    buf.write('    if (!_cancelled.isCompleted) _cancelled.complete();\n')
+    buf.write('  }\n')
+    buf.write('}\n\n')
+
+    buf.write('class RequestCancelled implements Exception {\n')
+    buf.write('  const RequestCancelled();\n\n')
+    buf.write('  @override\n')
+    buf.write("  String toString() => 'RequestCancelled';\n")
+    buf.write('}\n\n')
+
+    buf.write('class _InFlight {\n')
+    buf.write('  late final Future<Map<String, dynamic>> response;\n')
+    buf.write('  final released = Completer<void>();\n')
+    buf.write('  final void Function()? _onDone;\n')
+    buf.write('  var _waiting = 0;\n')
+    buf.write('  var _done = false;\n\n')
+    buf.write('  _InFlight([this._onDone]);\n\n')
+    buf.write('  void start(Future<Map<String, dynamic>> request) {\n')
+    buf.write('    response = request;\n')
+    buf.write('    request.then((_) => _finish(), onError: (_) => _finish());\n')
+    buf.write('  }\n\n')
+    buf.write('  void _finish() {\n')
+    buf.write('    if (_done) return;\n')
+    buf.write('    _done = true;\n')
+    buf.write('    _onDone?.call();\n')
+    buf.write('  }\n\n')
+    buf.write('  Future<Map<String, dynamic>> wait(CancelToken? cancel, Duration? timeout) async {\n')
+    buf.write('    _waiting++;\n')
+    buf.write('    try {\n')
+    buf.write('      var out = response;\n')
+    buf.write('      if (cancel != null) out = Future.any([out, cancel.whenCancelled.then((_) => throw const RequestCancelled())]);\n')
+    buf.write('      timeout ??= API.defaultTimeout;\n')
+    buf.write('      return await (timeout == null ? out : out.timeout(timeout));\n')
+    buf.write('    } finally {\n')
+    buf.write('      if (--_waiting == 0 && !released.isCompleted) {\n')
+    buf.write('        _finish();\n')
+    buf.write('        released.complete();\n')
+    buf.write('      }\n')
+    buf.write('    }\n')
+    buf.write('  }\n')
+    buf.write('}\n')
+
+def generate_response_cache_entry(buf: StringIO):
+    buf.write('\nclass _ResponseCacheEntry {\n')
+    buf.write('  final Map<String, dynamic> response;\n')
+    buf.write('  final String etag;\n')
+    buf.write('  DateTime expires;\n\n')
+    buf.write('  _ResponseCacheEntry(this.response, this.etag, this.expires);\n')
+    buf.write('}\n')
+
+def generate_frontend_endpoint(buf: StringIO, endpointName: str, endpointDetails: dict[str, Any]):
+    if endpoint_stream(endpointName, endpointDetails):
+        generate_frontend_stream_endpoint(buf, endpointName, endpointDetails)
+        return
+    buf.write(f'  static Future<{endpointDetails.get("out", "void")}> {endpointName}(')
+    if 'in' in endpointDetails:
+        buf.write(f'{endpointDetails["in"]} request, ')
+    buf.write('{CancelToken? cancel, Duration? timeout}) async {\n')
+    buf.write('    ')
+    if 'out' in endpointDetails:
+        buf.write('final res = ')
+    buf.write(f"await _send('{endpointName}', ")
+    if takes_body(endpointDetails):
+        buf.write('{')
         if 'in' in endpointDetails:
-            buf.write(f'{endpointDetails["in"]} request')
-        buf.write(') async {\n')
-        buf.write('    final Map<String, dynamic> res;\n')
-        buf.write('    final int code;\n')
+            buf.write(f"'data': {(toWire if binary_wire() else toJson)(endpointDetails['in'], 'request')}")
+            if sends_token(endpointDetails):
+                buf.write(', ')
+        if sends_token(endpointDetails):
+            buf.write(f"'token': {toJson(config['auth']['out'], '_token!')}")
+        buf.write('}')
+    else:
+        buf.write('null')
+    cache = endpoint_cache(endpointName, endpointDetails)
+    if cache is not None:
+        buf.write(f', cacheFor: const Duration(seconds: {cache.get("ttl", 60)})')
+    if endpoint_dedupe(endpointName, endpointDetails):
+        buf.write(', dedupe: true')
+    buf.write(', cancel: cancel, timeout: timeout);\n')
+
+    if 'out' in endpointDetails:
         buf.write('    try {\n')
-        if USE_HTTPS:
-            buf.write(f"      res = jsonDecode((await post(Uri.https('{API_URL}', '/{endpointName}')")
-        else:
-            buf.write(f"      res = jsonDecode((await post(Uri.http('{API_URL}', '/{endpointName}')")
-        
-        if 'in' in endpointDetails or 'authLevel' in endpointDetails or endpointDetails.get('forwardToken', False):
-            buf.write(', body: jsonEncode({')
-            if 'in' in endpointDetails:
-                buf.write(f"'data': {toJson(endpointDetails['in'], 'request')}")
-                if 'authLevel' in endpointDetails or endpointDetails.get('forwardToken', False):
-                    buf.write(', ')
-            if 'authLevel' in endpointDetails or endpointDetails.get('forwardToken', False):
-                buf.write(f"'token': {toJson(config['auth']['out'], '_token!')}")
-            buf.write("}), headers: {HttpHeaders.contentTypeHeader: 'application/json'}")
-        buf.write(')).body);\n')
-        buf.write("      code = res['code'] as int;\n")
+        buf.write('      return ')
+        buf.write((fromWire if binary_wire() else fromJson)(endpointDetails["out"], "res['data']"))
+        buf.write(';\n')
         buf.write('    } catch (e) {\n')
         buf.write('      _error(APIException.InternalError);\n')
-        buf.write('    }\n\n')
-        buf.write('    if (APIException.values[code] != APIException.Success) { _error(APIException.values[code]); }\n')
-
-        if 'out' in endpointDetails:
-            buf.write('    try {\n')
-            buf.write('      return ')
-            buf.write(fromJson(endpointDetails["out"], "res['data']"))
-            buf.write(';\n')
-            buf.write('    } catch (e) {\n')
-            buf.write('      _error(APIException.InternalError);\n')
-            buf.write('    }\n')
+        buf.write('    }\n')
 
-        buf.write('  }\n\n')
+    buf.write('  }\n\n')
+
+def generate_frontend_stream_endpoint(buf: StringIO, endpointName: str, endpointDetails: dict[str, Any]):
+    buf.write(f'  static Stream<{endpointDetails["out"]}> {endpointName}(')
+    if 'in' in endpointDetails:
+        buf.write(f'{endpointDetails["in"]} request')
+    buf.write(f") => _stream('{endpointName}', ")
+    if takes_body(endpointDetails):
+        body = []
+        if 'in' in endpointDetails:
+            body.append(f"'data': {toJson(endpointDetails['in'], 'request')}")
+        if sends_token(endpointDetails):
+            body.append(f"'token': {toJson(config['auth']['out'], '_token!')}")
+        buf.write(f'{{{", ".join(body)}}}')
+    else:
+        buf.write('null')
+    buf.write(').map((data) {\n')
+    buf.write('    try {\n')
+    buf.write(f'      return {fromJson(endpointDetails["out"], "data")};\n')
+    buf.write('    } catch (e) {\n')
+    buf.write('      _error(APIException.InternalError);\n')
+    buf.write('    }\n')
+    buf.write('  });\n\n')
+
+def generate_frontend(buf: Chunk):
+    section(buf, 'frontend head', None, generate_frontend_head)
+    section(buf, 'frontend transport', [bool(cached_endpoints()), bool(streamed_endpoints()), bool(deduped_endpoints())], generate_frontend_transport)
+    for endpointName, endpointDetails in all_endpoints().items():
+        section(buf, f'frontend endpoint {endpointName}', endpointDetails, lambda buf: generate_frontend_endpoint(buf, endpointName, endpointDetails))
+    buf.write('}\n')
+    if config.get('batch', False):
+        section(buf, 'frontend batched call', None, generate_batched_call)
+    section(buf, 'frontend cancellation', None, generate_cancellation)
+    if cached_endpoints():
+        section(buf, 'frontend response cache entry', None, generate_response_cache_entry)
+
+# the loadtest target is the server and the frontend plus stub handlers that hand back made up
+# data shaped like the schema, and a main() that runs the server in its own isolate and
+# hammers every endpoint at once over loopback, printing rps, latency and bytes for each
+SAMPLE_PRIMITIVES = {
+    'String': "'lorem ipsum dolor sit amet'",
+    'int': '42',
+    'double': '0.5',
+    'num': '42',
+    'bool': 'true',
+    'dynamic': 'null'
+}
+
+def loadtest_config() -> dict[str, Any]:
+    return config_dict('loadtest')
+
+# collections get kSampleSize elements until we're kSampleDepth classes down, then they're
+# empty (and nullables are null) so recursive classes still bottom out
+def sample_value(type: TypeNode, depth: str) -> str:
+    if type.kind == NULLABLE:
+        return f'({depth} > 0 ? {sample_value(type.args[0], depth)} : null)'
+    elif type.kind == LIST:
+        return f'[if ({depth} > 0) for (var i = 0; i < kSampleSize; i++) {sample_value(type.args[0], depth)}]'
+    elif type.kind == MAP:
+        key, value = type.args
+        if key.kind == ENUM:
+            entries = f'for (final k in {key.name}.values) k: {sample_value(value, depth)}'
+        elif key.name == 'String':
+            entries = f"for (var i = 0; i < kSampleSize; i++) 'key$i': {sample_value(value, depth)}"
+        elif key.name == 'int':
+            entries = f'for (var i = 0; i < kSampleSize; i++) i: {sample_value(value, depth)}'
+        else:
+            raise TypeError(f"Can't make up keys of type {key.name}!")
+        return f'{{if ({depth} > 0) {entries}}}'
+    elif type.kind == ENUM:
+        return f'{type.name}.values.first'
+    elif type.kind == CLASS:
+        return f'_sample{type.name}({depth} - 1)'
+    elif type.kind == EXT:
+        return f'_sample{ext_bases[type.name]}({depth} - 1).as{type.name}'
+    elif type.name in SAMPLE_PRIMITIVES:
+        return SAMPLE_PRIMITIVES[type.name]
+    raise TypeError(f"Don't know how to make up a {type.name}!")
+
+def sample(type: str) -> str:
+    return sample_value(resolve_type(type), 'kSampleDepth')
+
+def generate_loadtest_samples(buf: StringIO):
+    buf.write(f'const kSampleSize = {loadtest_config().get("collection_size", 10)};\n')
+    buf.write(f'const kSampleDepth = {loadtest_config().get("depth", 2)};\n\n')
+    for className, classData in config_dict('classes').items():
+        buf.write(f'{className} _sample{className}(int depth) => {className}(')
+        fields = [f'\n  {fieldName}: {sample_value(resolve_type(field_type(fieldType)[0]), "depth")}' for fieldName, fieldType in classData.items()]
+        buf.write(','.join(fields))
+        buf.write('\n);\n\n' if fields else ');\n\n')
+
+def stub_method(endpointName: str, endpointType: dict[str, Any]) -> str:
+    params = []
+    if endpointType.get('forwardToken', False):
+        params.append(f'{config["auth"]["out"]} token')
+    if 'in' in endpointType:
+        params.append(f'{endpointType["in"]} request')
+    method = f'  @override\n  {handler_out(endpointType)} {endpointName}({", ".join(params)})'
+    if endpointType.get('stream', False):
+        return f'{method} => Stream.fromIterable(List.filled(kSampleSize, _{endpointName}));\n'
+    elif 'out' in endpointType:
+        return f'{method} => _{endpointName};\n'
+    return f'{method} {{}}\n'
+
+# responses are made up once, up front, so what gets measured is the generated code rather
+# than building test data
+def generate_loadtest_handlers(buf: StringIO):
+    buf.write('class LoadTestHandler implements APIHandler {\n')
+    endpoints = {endpointName: endpointType for endpointName, endpointType in config_dict('endpoints').items() if endpointType.get('handledBy', 'main') == 'main'}
+    for endpointName, endpointType in endpoints.items():
+        if 'out' in endpointType:
+            buf.write(f'  final {endpointType["out"]} _{endpointName} = {sample(endpointType["out"])};\n')
+    buf.write('\n')
+    buf.write('\n'.join(stub_method(endpointName, endpointType) for endpointName, endpointType in endpoints.items()))
+    buf.write('}\n\n')
+
+    if 'auth' not in config:
+        return
+    # everyone gets the highest auth level, so every endpoint actually gets to its handler
+    buf.write('class LoadTestAuth implements AuthHandler {\n')
+    endpoints = {endpointName: endpointType for endpointName, endpointType in config_dict('endpoints').items() if endpointType.get('handledBy', 'main') == 'auth'}
+    buf.write(f'  final {config["auth"]["out"]} _token = {sample(config["auth"]["out"])};\n')
+    for endpointName, endpointType in endpoints.items():
+        if 'out' in endpointType:
+            buf.write(f'  final {endpointType["out"]} _{endpointName} = {sample(endpointType["out"])};\n')
+    methods = [
+        f'  @override\n  {handler_type(config["auth"]["out"], auth_async())} generateToken({config["auth"]["in"]} credentials) => _token;\n',
+        f'  @override\n  {handler_type("AuthLevel", auth_async())} validateToken({config["auth"]["out"]} token) => AuthLevel.values.last;\n'
+    ]
+    methods += [stub_method(endpointName, endpointType) for endpointName, endpointType in endpoints.items()]
+    for endpointName, endpointType in config_dict('endpoints').items():
+        if endpointType.get('authLevel', '') == 'Custom':
+            request = f', {endpointType["in"]} request' if 'in' in endpointType else ''
+            methods.append(f'  @override\n  {handler_type("bool", handler_async(endpointType))} {endpointName}Auth({config["auth"]["out"]} token{request}) => true;\n')
+    buf.write('\n')
+    buf.write('\n'.join(methods))
+    buf.write('}\n\n')
+
+def generate_loadtest_driver(buf: StringIO):
+    loadtestConfig = loadtest_config()
+    buf.write(f'const kLoadTestSeconds = {loadtestConfig.get("seconds", 5)};\n')
+    buf.write(f'const kLoadTestConcurrency = {loadtestConfig.get("concurrency", 8)};\n\n')
+
+    buf.write('Future<void> _loadTestServer(SendPort ready) async {\n')
+    buf.write('  final server = await HttpServer.bind(InternetAddress.loopbackIPv4, 0);\n')
+    buf.write('  ready.send(server.port);\n')
+    buf.write('  final handler = LoadTestHandler();\n')
+    buf.write('  final auth = LoadTestAuth();\n')
+    buf.write('  await for (final request in server) {\n')
+    buf.write('    handleRequest(request, handler, auth).catchError((e, t) {\n')
+    buf.write('      ' + log('error', "'Unhandled exception while handling request:\\n$e\\n$t'"))
+    buf.write('    });\n')
+    buf.write('  }\n')
+    buf.write('}\n\n')
+
+    # API only knows how to talk to api_url, so point everything it sends at our server instead.
+    # bytes are counted both ways, after HttpClient has undone any gzip
+    buf.write('class _LoopbackClient extends BaseClient {\n')
+    buf.write('  final int port;\n')
+    buf.write('  final Client _inner;\n')
+    buf.write('  final bytes = <String, int>{};\n\n')
+    buf.write('  _LoopbackClient(this.port, int connections) : _inner = IOClient(HttpClient()..maxConnectionsPerHost = connections);\n\n')
+    buf.write('  void _count(String endpoint, List<int> chunk) => bytes[endpoint] = (bytes[endpoint] ?? 0) + chunk.length;\n\n')
+    buf.write('  @override\n')
+    buf.write('  Future<StreamedResponse> send(BaseRequest request) async {\n')
+    buf.write('    final endpoint = request.url.path.substring(1);\n')
+    buf.write("    final redirected = StreamedRequest(request.method, request.url.replace(scheme: 'http', host: InternetAddress.loopbackIPv4.address, port: port))\n")
+    buf.write('      ..headers.addAll(request.headers)\n')
+    buf.write('      ..contentLength = request.contentLength;\n')
+    buf.write('    request.finalize().map((chunk) {\n')
+    buf.write('      _count(endpoint, chunk);\n')
+    buf.write('      return chunk;\n')
+    buf.write('    }).pipe(redirected.sink);\n')
+    buf.write('    final response = await _inner.send(redirected);\n')
+    buf.write('    return StreamedResponse(\n')
+    buf.write('      response.stream.map((chunk) {\n')
+    buf.write('        _count(endpoint, chunk);\n')
+    buf.write('        return chunk;\n')
+    buf.write('      }),\n')
+    buf.write('      response.statusCode,\n')
+    buf.write('      contentLength: response.contentLength,\n')
+    buf.write('      request: request,\n')
+    buf.write('      headers: response.headers,\n')
+    buf.write('      reasonPhrase: response.reasonPhrase\n')
+    buf.write('    );\n')
+    buf.write('  }\n\n')
+    buf.write('  @override\n')
+    buf.write('  void close() => _inner.close();\n')
+    buf.write('}\n\n')
+
+    buf.write('class _EndpointLoad {\n')
+    buf.write('  final latencies = <int>[];\n')
+    buf.write('  var errors = 0;\n\n')
+    buf.write('  int percentile(double p) => latencies[((latencies.length - 1) * p).round()];\n')
+    buf.write('}\n\n')
+
+    buf.write('Future<void> _drive(_EndpointLoad load, Future<void> Function() call, Stopwatch clock, int micros) async {\n')
+    buf.write('  while (clock.elapsedMicroseconds < micros) {\n')
+    buf.write('    final start = clock.elapsedMicroseconds;\n')
+    buf.write('    try {\n')
+    buf.write('      await call();\n')
+    buf.write('      load.latencies.add(clock.elapsedMicroseconds - start);\n')
+    buf.write('    } catch (e) {\n')
+    buf.write('      load.errors++;\n')
+    buf.write('    }\n')
+    buf.write('  }\n')
+    buf.write('}\n\n')
+
+    buf.write('String? _loadTestArg(List<String> args, String name) {\n')
+    buf.write('  for (final arg in args) {\n')
+    buf.write("    if (arg.startsWith('--$name=')) return arg.substring(name.length + 3);\n")
+    buf.write('  }\n')
+    buf.write('  return null;\n')
+    buf.write('}\n\n')
+
+    # requests are made up once too, same as the responses
+    calls = {}
+    for endpointName, endpointType in all_endpoints().items():
+        args = ''
+        if 'in' in endpointType:
+            args = f'_{endpointName.lstrip("_")}Request'
+            buf.write(f'final {endpointType["in"]} {args} = {sample(endpointType["in"])};\n')
+        if endpointName == '_authorize':
+            calls[endpointName] = f'API.authorize({args})'
+        elif endpoint_stream(endpointName, endpointType):
+            calls[endpointName] = f'API.{endpointName}({args}).drain<void>()'
+        else:
+            calls[endpointName] = f'API.{endpointName}({args})'
+    buf.write('\n')
 
+    buf.write('// dart run generated.dart [--seconds=N] [--concurrency=N] [--only=endpoint,endpoint]\n')
+    buf.write('Future<void> main(List<String> args) async {\n')
+    buf.write("  final seconds = int.parse(_loadTestArg(args, 'seconds') ?? '$kLoadTestSeconds');\n")
+    buf.write("  final concurrency = int.parse(_loadTestArg(args, 'concurrency') ?? '$kLoadTestConcurrency');\n")
+    buf.write("  final only = _loadTestArg(args, 'only')?.split(',');\n\n")
+    buf.write('  final calls = <String, Future<void> Function()>{\n')
+    for endpointName, call in calls.items():
+        buf.write(f"    '{endpointName}': () => {call},\n")
+    buf.write('  };\n')
+    buf.write('  if (only != null) calls.removeWhere((endpoint, _) => !only.contains(endpoint));\n\n')
+
+    buf.write('  final ready = ReceivePort();\n')
+    buf.write('  final server = await Isolate.spawn(_loadTestServer, ready.sendPort);\n')
+    buf.write('  final client = _LoopbackClient(await ready.first as int, concurrency * calls.length);\n')
+    buf.write('  API.clientFactory = () => client;\n')
+    if 'auth' in config:
+        buf.write(f'  await API.authorize(_authorizeRequest);\n')
+    buf.write('  client.bytes.clear();\n\n')
+
+    buf.write('  final loads = {for (final endpoint in calls.keys) endpoint: _EndpointLoad()};\n')
+    buf.write('  final clock = Stopwatch()..start();\n')
+    buf.write('  await Future.wait([\n')
+    buf.write('    for (final entry in calls.entries)\n')
+    buf.write('      for (var i = 0; i < concurrency; i++) _drive(loads[entry.key]!, entry.value, clock, seconds * 1000000)\n')
+    buf.write('  ]);\n')
+    buf.write('  final elapsed = clock.elapsedMicroseconds / 1000000;\n\n')
+
+    buf.write("  print('${'endpoint'.padRight(32)} ${'requests'.padLeft(9)} ${'rps'.padLeft(9)} ${'p50 ms'.padLeft(9)} ${'p99 ms'.padLeft(9)} ${'bytes/req'.padLeft(10)} ${'errors'.padLeft(7)}');\n")
+    buf.write('  for (final MapEntry(key: endpoint, value: load) in loads.entries) {\n')
+    buf.write('    final requests = load.latencies.length;\n')
+    buf.write('    load.latencies.sort();\n')
+    buf.write("    final p50 = requests == 0 ? '-' : (load.percentile(0.5) / 1000).toStringAsFixed(2);\n")
+    buf.write("    final p99 = requests == 0 ? '-' : (load.percentile(0.99) / 1000).toStringAsFixed(2);\n")
+    buf.write("    final bytes = requests == 0 ? '-' : ((client.bytes[endpoint] ?? 0) / requests).toStringAsFixed(0);\n")
+    buf.write("    print('${endpoint.padRight(32)} ${'$requests'.padLeft(9)} ${(requests / elapsed).toStringAsFixed(1).padLeft(9)} ${p50.padLeft(9)} ${p99.padLeft(9)} ${bytes.padLeft(10)} ${'${load.errors}'.padLeft(7)}');\n")
+    buf.write('  }\n\n')
+    buf.write('  API.dispose();\n')
+    buf.write('  server.kill();\n')
+    buf.write('  ready.close();\n')
     buf.write('}\n')
 
-def generate(target: str, output_dir: str, config_dir: str):
+def generate_loadtest(buf: Chunk):
+    section(buf, 'loadtest samples', config_dict('classes'), generate_loadtest_samples)
+    section(buf, 'loadtest handlers', config_dict('endpoints'), generate_loadtest_handlers)
+    section(buf, 'loadtest driver', config_dict('endpoints'), generate_loadtest_driver)
+
+def load_config(newConfig: Any):
     global config, API_URL, USE_HTTPS
-    config = get_config(config_dir)
+    config = newConfig
     API_URL = config['api_url']
     USE_HTTPS = config['use_https']
+    compile_schema()
+
+# which chunks of output each target is made of. the base section (models, enums etc) is
+# the same for everyone so it's only ever rendered once
+TARGET_JOBS = {
+    'server': ['server'],
+    'frontend': ['frontend'],
+    'thaum': ['server', 'frontend'],
+    'loadtest': ['server', 'frontend', 'loadtest']
+}
+
+def render_job(job: str, fname: str) -> dict[str, dict[str, Any]]:
+    with chunk_file(fname) as buf:
+        if job == 'base':
+            generate_base(buf)
+        elif job == 'server':
+            generate_server(buf)
+        elif job == 'frontend':
+            generate_frontend(buf)
+        elif job == 'loadtest':
+            generate_loadtest(buf)
+    return current_sections
+
+# process pool workers get their own copy of the schema (this also works with spawn on windows,
+# where the workers don't inherit anything from us)
+def init_worker(workerConfig: Any, previous: dict[str, dict[str, Any]]):
+    load_config(workerConfig)
+    start_sections(previous)
+
+def render_pooled_job(job: str, fname: str) -> dict[str, dict[str, Any]]:
+    start_sections(previous_sections)
+    try:
+        return render_job(job, fname)
+    finally:
+        close_sources()
+
+def generate(target: str, output_dir: str, config_dir: str) -> bool:
+    return generate_targets([(target, output_dir)], config_dir, parallel = False)[0]
+
+# imports have to be in the library file itself, even when everything else is split out
+def generate_imports(out: OutputFile, target: str):
+    out.write("import 'dart:io';\nimport 'dart:convert';\nimport 'dart:async';\n")
+    if 'server' in TARGET_JOBS[target]:
+        out.write("import 'dart:isolate';\n")
+    if 'frontend' in TARGET_JOBS[target]:
+        out.write("import 'package:http/http.dart';\nimport 'package:http/io_client.dart';\n")
+    if binary_wire():
+        out.write("import 'dart:typed_data';\n")
+    if lazy_fields_used():
+        out.write("import 'dart:collection';\n")
+    for extension in list(config_dict('extensions').values()):
+        out.write(f"import '{extension}.dart';\n")
+
+# with split_output on, generated.dart is just the imports plus a part for the models and one
+# for each job, so an edit that only touches the server leaves the other parts untouched
+OUTPUT_FILE = 'generated.dart'
+PART_FILES = {
+    'base': 'generated_models.dart',
+    'server': 'generated_server.dart',
+    'frontend': 'generated_frontend.dart',
+    'loadtest': 'generated_loadtest.dart'
+}
 
-    buf = StringIO()
-    buf.write("import 'dart:io';\nimport 'dart:convert';\n")
-    if target == 'frontend':
-        buf.write("import 'package:http/http.dart';\n")
-    generate_base(buf)
-
-    # can't use match cos we need to use python3.9 on the server due to a weird yaml bug in 3.10
-    if target == 'server':
-        generate_server(buf)
-    elif target == 'frontend':
-        generate_frontend(buf)
-    elif target == 'thaum':
-        generate_server(buf)
-        generate_frontend(buf)
+def outputs_intact(output_dir: str, manifest: dict[str, Any]) -> bool:
+    outputs = manifest.get('outputs')
+    return isinstance(outputs, dict) and OUTPUT_FILE in outputs and all(
+        path.exists(f'{output_dir}/{fname}') and file_hash(f'{output_dir}/{fname}') == outputHash
+        for fname, outputHash in outputs.items()
+    )
+
+# section offsets start out relative to the chunk they were rendered into, and only get pinned
+# to a file once the chunk's been written out
+def placed_sections(chunkSections: dict[str, dict[str, Any]], fname: str, start: int) -> dict[str, dict[str, Any]]:
+    return {key: {**placed, 'file': fname, 'offset': start + placed['offset']} for key, placed in chunkSections.items()}
+
+def write_target(target: str, output_dir: str, chunkDir: str, rendered: dict[str, dict[str, dict[str, Any]]], schemaHash: str) -> bool:
+    chunks = [(part, rendered[part]) for part in ['base'] + TARGET_JOBS[target]]
+    sections: dict[str, dict[str, Any]] = {}
+
+    written: list[OutputFile] = []
+    if config.get('split_output', False):
+        with output_file(f'{output_dir}/{OUTPUT_FILE}') as out:
+            generate_imports(out, target)
+            out.write('\n')
+            for part, _ in chunks:
+                out.write(f"part '{PART_FILES[part]}';\n")
+        written.append(out)
+        for part, chunkSections in chunks:
+            with output_file(f'{output_dir}/{PART_FILES[part]}') as out:
+                out.write(f"part of '{OUTPUT_FILE}';\n")
+                sections.update(placed_sections(chunkSections, PART_FILES[part], out.size))
+                out.copy_from(f'{chunkDir}/{part}')
+            written.append(out)
     else:
-        raise ValueError('Unsupported target!')
+        with output_file(f'{output_dir}/{OUTPUT_FILE}') as out:
+            generate_imports(out, target)
+            for part, chunkSections in chunks:
+                sections.update(placed_sections(chunkSections, OUTPUT_FILE, out.size))
+                out.copy_from(f'{chunkDir}/{part}')
+        written.append(out)
+
+    outputs = {path.basename(out.fname): out.digest() for out in written}
+    # parts from the last run that aren't part of this one (split_output got turned off, say)
+    for fname in read_manifest(output_dir).get('outputs', {}):
+        if fname not in outputs and path.exists(f'{output_dir}/{fname}'):
+            os.remove(f'{output_dir}/{fname}')
+
+    write_manifest(output_dir, {
+        'version': generator_version(),
+        'target': target,
+        'schema': schemaHash,
+        'outputs': outputs,
+        'sections': sections
+    })
+    return any(out.changed for out in written)
+
+def generate_targets(targets: list[tuple[str, str]], config_dir: str, parallel: bool = False) -> list[bool]:
+    for target, _ in targets:
+        if target not in TARGET_JOBS:
+            raise ValueError('Unsupported target!')
+
+    with span('check manifests'):
+        schema, schemaHash = read_schema(config_dir)
+
+        manifests = {output_dir: read_manifest(output_dir) for _, output_dir in targets}
+        intact = {output_dir: outputs_intact(output_dir, manifest) for output_dir, manifest in manifests.items()}
+        # fast path - same schema, same generator, same target and nobody's touched the output since
+        stale = [(target, output_dir) for target, output_dir in targets if not (
+            manifests[output_dir].get('version') == generator_version() and
+            manifests[output_dir].get('target') == target and
+            manifests[output_dir].get('schema') == schemaHash and
+            intact[output_dir]
+        )]
+    if len(stale) == 0:
+        return [False] * len(targets)
+
+    with span('parse schema'):
+        newConfig = parse_schema(schema, schemaHash)
+    with span('compile schema'):
+        load_config(newConfig)
+    # section fingerprints cover everything a section depends on, so it doesn't matter
+    # which target's manifest a cached section came from - but its offset only means anything
+    # while the file it points into is the one that manifest wrote
+    previous: dict[str, dict[str, Any]] = {}
+    for output_dir, manifest in manifests.items():
+        if manifest.get('version') == generator_version() and intact[output_dir]:
+            for key, placed in manifest.get('sections', {}).items():
+                previous[key] = {**placed, 'source': f'{output_dir}/{placed["file"]}'}
+    start_sections(previous)
+
+    jobs = sorted({job for target, _ in stale for job in TARGET_JOBS[target]})
+    rendered: dict[str, dict[str, dict[str, Any]]] = {}
+    changed = {}
+    with TemporaryDirectory() as chunkDir:
+        try:
+            with span('base'):
+                rendered['base'] = render_job('base', f'{chunkDir}/base')
+
+            # off unless asked for: base is most of the output and always renders here first,
+            # and starting the workers and handing them the schema and the previous sections
+            # costs more than the jobs left over for them. spans opened in worker processes
+            # would never make it back to us either
+            if parallel and len(jobs) > 1 and not profiling():
+                with ProcessPoolExecutor(max_workers = len(jobs), initializer = init_worker, initargs = (config, previous)) as pool:
+                    rendered.update(zip(jobs, pool.map(render_pooled_job, jobs, [f'{chunkDir}/{job}' for job in jobs])))
+            else:
+                for job in jobs:
+                    start_sections(previous)
+                    with span(job):
+                        rendered[job] = render_job(job, f'{chunkDir}/{job}')
+        finally:
+            # the outputs these point into are about to be replaced
+            close_sources()
+
+        for target, output_dir in stale:
+            with span(f'write {target}', output_dir = output_dir):
+                changed[output_dir] = write_target(target, output_dir, chunkDir, rendered, schemaHash)
 
-    with open(f'{output_dir}/generated.dart', 'wt') as fh:
-        fh.write(buf.getvalue())
\ No newline at end of file
+    return [changed.get(output_dir, False) for _, output_dir in targets]
@@ -3,15 +3,69 @@
 import os
 import os.path as path
 from shutil import copy
-from typing import Callable, Any
-from datetime import datetime
+from typing import Callable, Any, Optional
+from datetime import datetime, timezone
+from glob import glob
+from time import sleep, perf_counter
+from hashlib import sha256
+from argparse import ArgumentParser
+import subprocess
+import json
+import cProfile
+from contextlib import contextmanager
 from yaml import safe_load
-import platform
-from generate import generate
+try:
+    import fcntl
+except ImportError:
+    # windows
+    fcntl = None
+    import msvcrt
+from generate import generate_targets, load_schema, read_manifest, file_hash, MANIFEST_FILE, CACHE_DIR, span, start_profile, stop_profile
 
 target_config: Any
+offline: bool = False
+local_config_dir: Optional[str] = None
 
-def config_dir() -> str: return target_config['repo_url'].split('/')[-1]
+# local paths are relative to us, not to the cache - and the same repo reached by two
+# different relative paths is still the same repo
+def resolved_repo_url() -> str:
+    repo_url = target_config['repo_url']
+    return path.abspath(repo_url) if path.isdir(repo_url) else repo_url
+
+# config repos are mirrored in CACHE_DIR and kept between runs, one per repo url and ref, so
+# we only ever pay for a shallow fetch of whatever's changed and two projects pinned to
+# different refs never check each other's out from under them
+def config_dir() -> str:
+    if local_config_dir is not None: return local_config_dir
+    repo_url = resolved_repo_url()
+    name = repo_url.rstrip('/').split('/')[-1]
+    if name.endswith('.git'): name = name[:-4]
+    key = '\n'.join([repo_url, target_config.get('ref') or 'HEAD'])
+    return path.join(CACHE_DIR, f'{name}-{sha256(key.encode()).hexdigest()[:12]}')
+
+# runs sharing a cached copy (a CI matrix on one runner, say) take turns, so nobody's fetch
+# and checkout lands while someone else is still generating from it
+@contextmanager
+def config_lock():
+    if local_config_dir is not None:
+        yield
+        return
+    os.makedirs(CACHE_DIR, exist_ok = True)
+    with open(f'{config_dir()}.lock', 'a+b') as fh:
+        if fcntl is not None:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+        else:
+            while True:
+                try:
+                    msvcrt.locking(fh.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK only retries for 10 seconds before giving up
+                    pass
+        # closing the file lets go of the lock
+        yield
+
+VERSION = 'Thaumaturge v1.1'
 
 OUTPUT_DIR = {
     'server': 'bin',
@@ -20,62 +74,206 @@ OUTPUT_DIR = {
 
 def run_stage(fn: Callable[[], None], msg: str):
     print(f'{msg}... ', end = '', flush = True)
-    start = datetime.now()
-    fn()
-    end = datetime.now()
-    duration = end - start
-    print(f'Done ({duration.seconds}.{duration.microseconds:06}s)')
+    start = perf_counter()
+    with span(msg):
+        fn()
+    print(f'Done ({perf_counter() - start:.6f}s)')
+
+def git(*args: str) -> bool:
+    return subprocess.run(['git', '-C', config_dir(), *args]).returncode == 0
+
+def git_has_commit(ref: str) -> bool:
+    return subprocess.run(['git', '-C', config_dir(), 'rev-parse', '--verify', '--quiet', f'{ref}^{{commit}}'], stdout = subprocess.DEVNULL).returncode == 0
+
+# a shallow fetch of a tag or a branch only ever sets FETCH_HEAD, so the local ref of the same
+# name is either missing or stale. whatever commit an online run ends up on gets pinned here
+# instead, and --offline builds exactly that
+def pinned_ref() -> str:
+    return f"refs/thaum/{sha256((target_config.get('ref') or 'HEAD').encode()).hexdigest()[:16]}"
 
 def download_config():
-    os.system(f'git clone --quiet {target_config["repo_url"]}')
+    ref = target_config.get('ref')
+    if not path.exists(path.join(config_dir(), '.git')):
+        if offline:
+            raise FileNotFoundError(f"No cached copy of {target_config['repo_url']} to use offline!")
+        os.makedirs(config_dir(), exist_ok = True)
+        git('init', '--quiet')
+        git('remote', 'add', 'origin', resolved_repo_url())
+    
+    if not offline:
+        # ref can be a branch, a tag or a commit. not every server lets you fetch a bare
+        # commit hash so if the shallow fetch fails fall back to grabbing everything
+        if not git('fetch', '--quiet', '--depth', '1', 'origin', ref or 'HEAD'):
+            # an earlier shallow fetch leaves the history cut off, and a plain fetch won't
+            # go back past that to find an older commit
+            unshallow = ['--unshallow'] if path.exists(path.join(config_dir(), '.git', 'shallow')) else []
+            if not git('fetch', '--quiet', '--tags', *unshallow, 'origin'):
+                raise RuntimeError(f"Couldn't fetch {target_config['repo_url']}!")
+            # the remote's branch over any local one left behind by an older checkout
+            candidates = [f'refs/remotes/origin/{ref}', ref] if ref is not None else ['refs/remotes/origin/HEAD', 'FETCH_HEAD']
+            found = next((candidate for candidate in candidates if git_has_commit(candidate)), None)
+            if found is None or not git('checkout', '--quiet', '--force', found):
+                raise RuntimeError(f"Couldn't find '{ref or 'HEAD'}' in {target_config['repo_url']}!")
+        elif not git('checkout', '--quiet', '--force', 'FETCH_HEAD'):
+            raise RuntimeError(f"Couldn't check out '{ref or 'HEAD'}' from {target_config['repo_url']}!")
+        if not git('update-ref', pinned_ref(), 'HEAD'):
+            raise RuntimeError(f"Couldn't record which commit of {target_config['repo_url']} was fetched!")
+    elif not git_has_commit(pinned_ref()) or not git('checkout', '--quiet', '--force', pinned_ref()):
+        raise RuntimeError(f"'{ref or 'HEAD'}' isn't in the cached copy of {target_config['repo_url']}!")
+
+# thaum.yaml either has a single target/output_dir or a list of them under targets, which
+# all get generated from the same copy of the config in one go
+def targets() -> list[dict[str, str]]:
+    if 'targets' in target_config:
+        return target_config['targets']
+    return [{'target': target_config['target'], 'output_dir': target_config['output_dir']}]
+
+def ext_targets() -> list[dict[str, str]]:
+    return [target for target in targets() if target['target'] != 'thaum']
 
 def configure():
-    generate(target_config['target'], target_config['output_dir'], config_dir())
-    add_ignore_listing(f'{target_config["output_dir"]}/generated.dart')
+    with span('generate'):
+        generate_targets(
+            [(target['target'], target['output_dir']) for target in targets()],
+            config_dir(),
+            parallel = target_config.get('parallel', False)
+        )
+    with span('update .gitignore'):
+        for target in targets():
+            # generated.dart, plus its parts if the output's split
+            for fname in read_manifest(target['output_dir']).get('outputs', {}):
+                add_ignore_listing(f'{target["output_dir"]}/{fname}')
+            add_ignore_listing(f'{target["output_dir"]}/{MANIFEST_FILE}')
 
 def add_ignore_listing(file: str):
     if not path.exists('.gitignore'):
         open('.gitignore', 'w').close()
     
     with open('.gitignore', 'rt') as fh:
-        lines = fh.readlines()
+        lines = [line.rstrip('\n') for line in fh.readlines()]
 
     if file not in lines:
         with open('.gitignore', 'at') as fh:
             fh.write(f'{file}\n')
 
+def copy_ext(ext: str, output_dir: str):
+    source = f'{config_dir()}/ext/{ext}.dart'
+    dest = f'{output_dir}/{ext}.dart'
+    # same deal as generated.dart - don't bump the mtime if nothing's changed
+    if not path.exists(dest) or file_hash(source) != file_hash(dest):
+        copy(source, dest)
+    add_ignore_listing(dest)
+
+def configured_exts() -> list[str]:
+    return list(load_schema(config_dir()).get('extensions', {}).values())
+
 def configure_exts():
-    with open(f'{config_dir()}/generate.yaml', 'rt') as fh:
-        contents = safe_load(fh)
-
-    for ext in list(contents['extensions'].values()):
-        copy(f'{config_dir()}/ext/{ext}.dart', f'{target_config["output_dir"]}/{ext}.dart')
-        ignore_file = f'{target_config["output_dir"]}/{ext}.dart'
-        add_ignore_listing(ignore_file)
-
-def cleanup():
-    if platform.system() == 'Windows':
-        os.system(f'rmdir /s /q {config_dir()}')
-    elif platform.system() == 'Linux':
-        os.system(f'rm -rf {config_dir()}')
-    else:
-        raise ValueError('Unsupported platform!')
+    for ext in configured_exts():
+        with span(ext):
+            for target in ext_targets():
+                copy_ext(ext, target['output_dir'])
+
+# --profile writes the span tree out as json so CI can keep track of how long generation
+# takes. --pstats runs the whole thing under cProfile too, for when you want to know why
+def write_profile(profile: dict[str, Any], fname: str):
+    report = {
+        'version': VERSION,
+        'started': profile.pop('started'),
+        'seconds': profile['seconds'],
+        'spans': profile['children']
+    }
+    with open(fname, 'wt') as fh:
+        json.dump(report, fh, indent = 2)
+    print(f'Wrote timing report to {fname}')
+
+WATCH_INTERVAL = 0.05
+
+def watched_files() -> dict[str, int]:
+    out = {}
+    for fname in [f'{config_dir()}/generate.yaml'] + glob(f'{config_dir()}/ext/*.dart'):
+        try:
+            out[fname] = os.stat(fname).st_mtime_ns
+        except FileNotFoundError:
+            pass
+    return out
+
+def regenerate(changed: list[str]):
+    if f'{config_dir()}/generate.yaml' in changed:
+        configure()
+        configure_exts()
+        return
+
+    exts = configured_exts()
+    for fname in changed:
+        ext = path.splitext(path.basename(fname))[0]
+        if ext in exts and path.exists(fname):
+            for target in ext_targets():
+                copy_ext(ext, target['output_dir'])
+
+def watch():
+    print(f'Watching {config_dir()} for changes (Ctrl+C to stop)')
+    last = watched_files()
+    try:
+        while True:
+            sleep(WATCH_INTERVAL)
+            current = watched_files()
+            changed = [fname for fname in set(current) | set(last) if current.get(fname) != last.get(fname)]
+            if not changed: continue
+            last = current
+
+            start = perf_counter()
+            try:
+                regenerate(changed)
+            except Exception as e:
+                # half-typed schemas are the norm while you're editing, just wait for the next save
+                print(f'Regeneration failed:\n{e}')
+                continue
+            names = ', '.join(sorted(path.relpath(fname, config_dir()) for fname in changed))
+            print(f'{names} changed, regenerated in {(perf_counter() - start) * 1000:.1f}ms')
+    except KeyboardInterrupt:
+        pass
 
 def main():
-    global config
-    print('Thaumaturge v1.1')
-    global target_config
+    global target_config, offline, local_config_dir
+    parser = ArgumentParser(description = 'Thaumaturge API generator')
+    parser.add_argument('--offline', action = 'store_true', help = 'use the cached config repo without fetching')
+    parser.add_argument('--config-dir', help = 'use a local config directory instead of repo_url')
+    parser.add_argument('--watch', action = 'store_true', help = 'keep running and regenerate whenever the config changes')
+    parser.add_argument('--profile', nargs = '?', const = 'thaum-profile.json', metavar = 'REPORT', help = 'time each stage, phase and schema entity and write the timings to REPORT as json')
+    parser.add_argument('--pstats', metavar = 'FILE', help = 'run under cProfile and dump the stats to FILE')
+    args = parser.parse_args()
+    offline = args.offline
+    local_config_dir = args.config_dir
+
+    print(VERSION)
     with open('thaum.yaml', 'rt') as fh:
         target_config = safe_load(fh)
-    run_stage(download_config, 'Downloading configuration')
-    print('---\nLast commit:')
-    os.system(f'git -C {config_dir()} log -1 --pretty=format:%B')
-    print('---')
-    try:
+
+    if args.profile is not None:
+        profile = start_profile('thaum')
+        profile['started'] = datetime.now(timezone.utc).isoformat()
+    profiler = cProfile.Profile() if args.pstats is not None else None
+    if profiler is not None:
+        profiler.enable()
+
+    with config_lock():
+        if local_config_dir is None:
+            run_stage(download_config, 'Using cached configuration' if offline else 'Downloading configuration')
+            print('---\nLast commit:')
+            git('log', '-1', '--pretty=format:%B')
+            print('---')
         run_stage(configure, 'Configuring')
-        if target_config['target'] != 'thaum':
+        if len(ext_targets()) > 0:
             run_stage(configure_exts, 'Configuring extensions')
-    finally:
-        run_stage(cleanup, 'Cleaning up')
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.pstats)
+        print(f'Wrote cProfile stats to {args.pstats}')
+    if args.profile is not None:
+        write_profile(stop_profile(), args.profile)
+
+    if args.watch:
+        watch()
 
 if __name__ == '__main__': main()
\ No newline at end of file